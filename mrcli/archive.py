@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Session archives for recording and offline replay.
+
+An Archive is a pair of append-only files. The data file holds one
+compressed record per fan-out, per device result and per inventory poll.
+The index file (the data file name plus '.idx') holds one small entry per
+data record, keyed by record kind, device name and command, so that a
+lookup seeks directly to the record rather than scanning the data file.
+
+If the index file is missing, ends with a partially written entry, or
+does not cover the whole data file (after a crash mid-write), it is
+rebuilt from the data file when the archive is opened. A partially
+written final data record is truncated if the archive is writable, so
+that later records are not appended after it.
+"""
+
+import marshal
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+INDEX_SUFFIX = '.idx'
+
+# Record kinds.
+KIND_FANOUT = 'f'
+KIND_RESULT = 'r'
+KIND_DEVICES = 'd'
+
+# Each data record is a length header followed by a compressed payload.
+_HEADER = struct.Struct('>I')
+
+
+class Error(Exception):
+    """An archive could not be read or written."""
+
+
+class ArchivedError(Exception):
+    """Base class for errors recreated from an archive."""
+
+
+_error_classes = {}
+
+
+def error_class(name):
+    """Returns an exception class named 'name' for replayed errors."""
+    if name not in _error_classes:
+        _error_classes[name] = type(str(name), (ArchivedError,), {})
+    return _error_classes[name]
+
+
+class Archive(object):
+    """An append-only archive of fan-out results, indexed by device and command.
+
+    Attributes:
+      path: The data file path.
+      writable: True if the archive was opened for recording.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._lock = threading.Lock()
+        # (device_name, command) -> [(offset, length), ...], oldest first.
+        self._results = {}
+        self._fanouts = []
+        self._devices = []
+        self._next_fanout = 0
+
+        if not writable and not os.path.exists(path):
+            raise Error('No such archive: %s' % path)
+        index_path = path + INDEX_SUFFIX
+        try:
+            if (os.path.exists(path) and
+                not (os.path.exists(index_path) and
+                     self._load_index(index_path))):
+                self._clear_entries()
+                self._rebuild_index(writable and index_path or None)
+            mode = writable and 'ab' or 'rb'
+            self._data = open(path, mode)
+            self._index = writable and open(index_path, 'ab') or None
+        except (IOError, OSError), e:
+            raise Error(str(e))
+
+    def _clear_entries(self):
+        self._results = {}
+        self._fanouts = []
+        self._devices = []
+
+    def _add_entry(self, kind, device_name, command, offset, length):
+        entry = (offset, length)
+        if kind == KIND_RESULT:
+            self._results.setdefault((device_name, command), []).append(entry)
+        elif kind == KIND_FANOUT:
+            self._fanouts.append(entry)
+        elif kind == KIND_DEVICES:
+            self._devices.append(entry)
+
+    def _load_index(self, index_path):
+        """Loads the index file.
+
+        Returns:
+          True if the index is intact and covers the whole data file.
+        """
+        f = open(index_path, 'rb')
+        good = end = 0
+        try:
+            while True:
+                try:
+                    entry = marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    # End of index, or a partially written final entry.
+                    break
+                self._add_entry(*entry)
+                good = f.tell()
+                end = max(end, entry[3] + _HEADER.size + entry[4])
+        finally:
+            f.close()
+        self._next_fanout = len(self._fanouts)
+        return (good == os.path.getsize(index_path) and
+                end == os.path.getsize(self.path))
+
+    def _rebuild_index(self, index_path=None):
+        """Rebuilds the index from the data file.
+
+        Args:
+          index_path: The index file to write, or None to only rebuild the
+            index in memory (for archives that are not writable). If given,
+            a partially written final data record is also truncated.
+        """
+        data = open(self.path, index_path and 'r+b' or 'rb')
+        index = index_path and open(index_path, 'wb')
+        try:
+            offset = 0
+            while True:
+                header = data.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length = _HEADER.unpack(header)[0]
+                payload = data.read(length)
+                if len(payload) < length:
+                    break
+                try:
+                    record = marshal.loads(zlib.decompress(payload))
+                except (zlib.error, EOFError, ValueError, TypeError):
+                    break
+                key = (record['kind'], record.get('device_name'),
+                       record.get('command'), offset, length)
+                if index:
+                    marshal.dump(key, index)
+                self._add_entry(*key)
+                offset += _HEADER.size + length
+            if index:
+                data.truncate(offset)
+        finally:
+            data.close()
+            if index:
+                index.close()
+        self._next_fanout = len(self._fanouts)
+
+    def _append(self, record):
+        if not self.writable:
+            raise Error('Archive %s is not open for recording' % self.path)
+        payload = zlib.compress(marshal.dumps(record))
+        self._lock.acquire()
+        try:
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            self._data.write(_HEADER.pack(len(payload)))
+            self._data.write(payload)
+            self._data.flush()
+            key = (record['kind'], record.get('device_name'),
+                   record.get('command'), offset, len(payload))
+            marshal.dump(key, self._index)
+            self._index.flush()
+            self._add_entry(*key)
+        finally:
+            self._lock.release()
+
+    def _read(self, entry):
+        offset, length = entry
+        self._lock.acquire()
+        try:
+            self._data.seek(offset + _HEADER.size)
+            payload = self._data.read(length)
+        finally:
+            self._lock.release()
+        return marshal.loads(zlib.decompress(payload))
+
+    def new_fanout(self):
+        """Returns the identifier to use for the next fan-out."""
+        self._lock.acquire()
+        try:
+            fanout = self._next_fanout
+            self._next_fanout += 1
+            return fanout
+        finally:
+            self._lock.release()
+
+    def record_fanout(self, fanout, command, targets, started, elapsed):
+        """Records a completed fan-out."""
+        self._append({'kind': KIND_FANOUT,
+                      'fanout': fanout,
+                      'command': command,
+                      'targets': list(targets),
+                      'time': started,
+                      'elapsed': elapsed})
+
+    def record_result(self, fanout, device_name, command, result=None,
+                      error=None, elapsed=None):
+        """Records one device's result (or error) for a fan-out."""
+        if error is not None:
+            error = (error.__class__.__name__, str(error))
+        self._append({'kind': KIND_RESULT,
+                      'fanout': fanout,
+                      'device_name': device_name,
+                      'command': command,
+                      'result': result,
+                      'error': error,
+                      'time': time.time(),
+                      'elapsed': elapsed})
+
+    def record_devices(self, devices):
+        """Records the device inventory (as returned by devices_info)."""
+        self._append({'kind': KIND_DEVICES,
+                      'devices': devices,
+                      'time': time.time()})
+
+    def lookup(self, device_name, command):
+        """Returns the latest result record for a device and command, or None.
+        """
+        entries = self._results.get((device_name, command))
+        if entries:
+            return self._read(entries[-1])
+
+    def history(self, device_name, command):
+        """Yields every result record for a device and command, oldest first.
+        """
+        for entry in list(self._results.get((device_name, command), ())):
+            yield self._read(entry)
+
+    def fanouts(self):
+        """Yields every fan-out record, oldest first."""
+        for entry in list(self._fanouts):
+            yield self._read(entry)
+
+    def device_names(self):
+        """Returns the sorted names of all devices in the archive."""
+        names = set(name for name, _ in self._results)
+        devices = self.devices()
+        if devices:
+            names.update(devices)
+        return sorted(names)
+
+    def devices(self):
+        """Returns the most recently recorded device inventory, or {}."""
+        if self._devices:
+            return self._read(self._devices[-1])['devices']
+        return {}
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._data.close()
+            if self._index is not None:
+                self._index.close()
+        finally:
+            self._lock.release()
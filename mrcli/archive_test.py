@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the archive module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import archive
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.mra')
+        self.index_path = self.path + archive.INDEX_SUFFIX
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, *results):
+        a = archive.Archive(self.path, writable=True)
+        for result in results:
+            a.record_result(a.new_fanout(), 'ar1.syd', 'show ver', result)
+        return a
+
+    def lookup(self):
+        a = archive.Archive(self.path)
+        try:
+            record = a.lookup('ar1.syd', 'show ver')
+            return record and record['result']
+        finally:
+            a.close()
+
+    def testRoundTrip(self):
+        a = self.record('one')
+        a.record_fanout(0, 'show ver', ['ar1.syd'], 0.0, 1.5)
+        a.record_devices({'ar1.syd': {'device_type': 'juniper'}})
+        a.record_result(1, 'ar1.syd', 'show ver', error=ValueError('bad'))
+        a.close()
+
+        a = archive.Archive(self.path)
+        self.assertEqual(['ar1.syd'], a.device_names())
+        self.assertEqual([['ar1.syd']], [f['targets'] for f in a.fanouts()])
+        self.assertEqual({'ar1.syd': {'device_type': 'juniper'}}, a.devices())
+        self.assertEqual([('one', None), (None, ('ValueError', 'bad'))],
+                         [(r['result'], r['error'])
+                          for r in a.history('ar1.syd', 'show ver')])
+        self.assertEqual(None, a.lookup('ar1.syd', 'show int'))
+        self.assertEqual(1, a.new_fanout())
+        a.close()
+
+    def testLookupReturnsLatest(self):
+        self.record('one', 'two').close()
+        self.assertEqual('two', self.lookup())
+
+    def testNotWritable(self):
+        self.assertRaises(archive.Error, archive.Archive, self.path)
+        self.record('one').close()
+        a = archive.Archive(self.path)
+        self.assertRaises(archive.Error, a.record_devices, {})
+        a.close()
+
+    def testMissingIndexIsRebuilt(self):
+        self.record('one', 'two').close()
+        os.remove(self.index_path)
+        self.assertEqual('two', self.lookup())
+        self.assertFalse(os.path.exists(self.index_path))
+        archive.Archive(self.path, writable=True).close()
+        self.assertTrue(os.path.exists(self.index_path))
+        self.assertEqual('two', self.lookup())
+
+    def testTornIndexEntry(self):
+        self.record('one').close()
+        size = os.path.getsize(self.index_path)
+        self.record('lost').close()
+        f = open(self.index_path, 'r+b')
+        f.truncate(size + 3)
+        f.close()
+        # The record whose index entry was torn is recovered, and records
+        # appended afterwards are found.
+        self.assertEqual('lost', self.lookup())
+        self.record('two').close()
+        self.assertEqual('two', self.lookup())
+        a = archive.Archive(self.path)
+        self.assertEqual(['one', 'lost', 'two'],
+                         [r['result'] for r in a.history('ar1.syd',
+                                                         'show ver')])
+        a.close()
+
+    def testTornDataRecord(self):
+        self.record('one').close()
+        size = os.path.getsize(self.path)
+        self.record('torn').close()
+        f = open(self.path, 'r+b')
+        f.truncate(size + 5)
+        f.close()
+        self.assertEqual('one', self.lookup())
+        self.record('two').close()
+        self.assertEqual('two', self.lookup())
+        os.remove(self.index_path)
+        self.assertEqual('two', self.lookup())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Mr. CLI benchmarks.
+
+Starts a stand-in Notch Agent (see fakeagent.py) in a child process and
+drives MisterCLI against it end to end: start up, target resolution, and
+command fan-outs through each output mode (the pager's output is
+discarded). Results are appended as one
+JSON line per run to a results file, and compared against the previous
+run with the same settings.
+
+  $ mrcli-bench --devices 2000 --latency exp:0.2 --errors 0.01
+"""
+
+import httplib
+import json
+import math
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+RESULTS_FILE = 'mrcli_bench.jsonl'
+
+# Metrics compared between runs, and whether larger values are better.
+COMPARED = (('throughput', True), ('p50', False), ('p99', False),
+            ('wall', False), ('peak_rss_kb', False))
+# The change at which a metric is reported as a possible regression.
+REGRESSION_PERCENT = 10
+# Allowed difference between the observed and configured error rates,
+# beyond four standard deviations.
+ERROR_MARGIN = 0.02
+# The pager used by the pager output mode.
+PAGER = 'cat > /dev/null'
+
+
+class Error(Exception):
+    """The benchmark cannot run, or its results are not meaningful."""
+
+
+class _NullOutput(object):
+    """Discards output, counting the bytes written."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    def flush(self):
+        pass
+
+
+class _PagedOutput(object):
+    """Writes to a pager, counting the bytes written in 'counter'."""
+
+    def __init__(self, pager, counter):
+        self.pager = pager
+        self.counter = counter
+
+    def write(self, data):
+        self.counter.bytes += len(data)
+        self.pager.write(data)
+
+    def flush(self):
+        self.pager.flush()
+
+
+def percentile(values, fraction):
+    """Returns the value at 'fraction' (0..1) of the sorted values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def use_connection_per_request():
+    """Makes the Notch client open a new HTTP connection per request.
+
+    From Python 2.7, xmlrpclib (and so jsonrpclib) keeps each transport's
+    HTTP connection open between requests. The client's green threads
+    share each agent's transport, so concurrent requests would share its
+    connection and fail with CannotSendRequest or ResponseNotReady.
+    """
+    import jsonrpclib.jsonrpc
+    transport = jsonrpclib.jsonrpc.Transport
+    if not hasattr(transport(), '_connection'):
+        return
+
+    def make_connection(self, host):
+        chost, self._extra_headers, _ = self.get_host_info(host)
+        return httplib.HTTPConnection(chost)
+
+    transport.make_connection = make_connection
+
+
+def check_error_rate(name, metrics, expected):
+    """Raises Error if a scenario's error rate is not the configured one.
+
+    A mismatch means the requests failed for some other reason (such as
+    the transport), so the timings are not those of Mr. CLI.
+    """
+    requests = metrics['requests']
+    if not requests:
+        raise Error('%s: no responses were received.' % name)
+    observed = float(metrics['errors']) / requests
+    allowed = (4 * math.sqrt(expected * (1 - expected) / requests)
+               + ERROR_MARGIN)
+    if abs(observed - expected) > allowed:
+        raise Error('%s: %d of %d requests failed (%.1f%%, expected '
+                    '%.1f%%): %s' % (
+                name, metrics['errors'], requests, observed * 100,
+                expected * 100,
+                ', '.join('%s x%d' % (k, v) for k, v in
+                          sorted(metrics['error_types'].items()))))
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def start_agent(options):
+    """Starts the fake agent, returning (process, port)."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fakeagent.py')
+    args = [sys.executable, script,
+            '--devices', str(options.devices),
+            '--latency', options.latency,
+            '--errors', str(options.error_rate),
+            '--output-lines', str(options.output_lines)]
+    if options.seed is not None:
+        args.extend(['--seed', str(options.seed)])
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    if not line.strip():
+        raise SystemExit('The fake agent did not start.')
+    return process, int(line)
+
+
+def _make_cli(mrcli, nc):
+    """Returns a MisterCLI recording per-request latencies."""
+
+    class BenchCLI(mrcli.MisterCLI):
+
+        def _open_pager(self):
+            self.pager = mrcli.pager.Pager(PAGER)
+            self._unpaged_stdout = self.stdout
+            self.stdout = _PagedOutput(self.pager, self.stdout)
+
+        def __init__(self, *args, **kwargs):
+            super(BenchCLI, self).__init__(*args, **kwargs)
+            self.latencies = []
+            self.error_types = {}
+
+        def _notch_callback(self, request, *args, **kwargs):
+            if request.time_sent is not None:
+                self.latencies.append(time.time() - request.time_sent)
+            if request.error is not None:
+                name = request.error.__class__.__name__
+                self.error_types[name] = self.error_types.get(name, 0) + 1
+            return super(BenchCLI, self)._notch_callback(
+                request, *args, **kwargs)
+
+    cli = BenchCLI(nc, stdout=_NullOutput())
+    cli.timeout = 600.0
+    return cli
+
+
+def run_fanout(cli, mode, command, iterations):
+    """Runs a command fan-out in an output mode, returning its metrics."""
+    cli.latencies = []
+    cli.error_types = {}
+    # The pager output mode is only available interactively.
+    cli.from_cmd_loop = (mode == 'pager')
+    cli.do_output('output %s' % mode)
+    errors = 0
+    start = time.time()
+    for _ in xrange(iterations):
+        cli.do_command('cmd %s' % command)
+        errors += cli.fanout.errors
+    wall = time.time() - start
+    requests = len(cli.latencies)
+    return {'requests': requests,
+            'errors': errors,
+            'error_types': cli.error_types,
+            'wall': wall,
+            'throughput': requests / wall if wall else None,
+            'p50': percentile(cli.latencies, 0.50),
+            'p90': percentile(cli.latencies, 0.90),
+            'p99': percentile(cli.latencies, 0.99),
+            'max': percentile(cli.latencies, 1.0),
+            'output_bytes': cli.stdout.bytes,
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def run(options):
+    """Runs the benchmarks, returning the results record."""
+    concurrency = options.concurrency
+    settings = {'devices': options.devices,
+                'latency': options.latency,
+                'error_rate': options.error_rate,
+                'output_lines': options.output_lines,
+                'iterations': options.iterations,
+                'concurrency': concurrency}
+    results = {'time': time.time(), 'settings': settings, 'scenarios': {}}
+    scenarios = results['scenarios']
+    if concurrency:
+        os.environ['NOTCH_CONCURRENCY'] = str(concurrency)
+
+    use_connection_per_request()
+    agent, port = start_agent(options)
+    try:
+        start = time.time()
+        # Imported here so that the import is part of the start up time.
+        import mrcli
+        nc = mrcli.notch.client.Connection(['127.0.0.1:%d' % port])
+        cli = _make_cli(mrcli, nc)
+        scenarios['startup'] = {'wall': time.time() - start,
+                                'peak_rss_kb': peak_rss_kb()}
+
+        start = time.time()
+        cli.do_targets('targets ^bench.*')
+        scenarios['resolve'] = {'wall': time.time() - start,
+                                'targets': len(cli.targets),
+                                'peak_rss_kb': peak_rss_kb()}
+
+        modes = options.modes.split(',')
+        for mode in modes:
+            if mode == 'csv' and mrcli.netmunge is None:
+                continue
+            cli.stdout.bytes = 0
+            name = 'fanout_' + mode
+            scenarios[name] = run_fanout(
+                cli, mode, options.command, options.iterations)
+            check_error_rate(name, scenarios[name], options.error_rate)
+    finally:
+        agent.terminate()
+        agent.wait()
+    return results
+
+
+def load_previous(path, settings):
+    """Returns the last results record in path with the same settings."""
+    previous = None
+    if not os.path.exists(path):
+        return None
+    f = open(path)
+    try:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('settings') == settings:
+                previous = record
+    finally:
+        f.close()
+    return previous
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    elif isinstance(value, float):
+        return '%.4f' % value
+    else:
+        return str(value)
+
+
+def report(results, previous, out=sys.stdout):
+    """Writes a summary of results, with changes since previous."""
+    out.write('Settings: %s\n' % ', '.join(
+        '%s=%s' % (k, v) for k, v in sorted(results['settings'].items())))
+    for name, metrics in sorted(results['scenarios'].items()):
+        out.write('\n%s\n' % name)
+        before = {}
+        if previous is not None:
+            before = previous['scenarios'].get(name, {})
+        for key in sorted(metrics):
+            line = '  %-14s %s' % (key, _format(metrics[key]))
+            old = before.get(key)
+            if (old and isinstance(old, (int, float))
+                and metrics[key] is not None):
+                line += '  (%+.1f%%)' % (
+                    (metrics[key] - old) * 100.0 / old)
+            out.write(line + '\n')
+    regressions = find_regressions(results, previous)
+    if regressions:
+        out.write('\nPossible regressions (more than %d%% worse):\n'
+                  % REGRESSION_PERCENT)
+        for r in regressions:
+            out.write('  %s\n' % r)
+
+
+
+def find_regressions(results, previous):
+    """Returns descriptions of metrics which have worsened since previous.
+    """
+    regressions = []
+    if previous is None:
+        return regressions
+    for name, metrics in sorted(results['scenarios'].items()):
+        before = previous['scenarios'].get(name, {})
+        for key, larger_is_better in COMPARED:
+            old, new = before.get(key), metrics.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) * 100.0 / old
+            if larger_is_better:
+                change = -change
+            if change > REGRESSION_PERCENT:
+                regressions.append('%s %s: %s -> %s' % (
+                    name, key, _format(old), _format(new)))
+    return regressions
+
+
+def get_option_parser():
+    parser = optparse.OptionParser()
+    parser.usage = '%prog [options]'
+    parser.add_option('-d', '--devices', dest='devices', type='int',
+                      default=1000, help='Number of fake devices')
+    parser.add_option('-l', '--latency', dest='latency', default='exp:0.05',
+                      help='Command latency distribution: fixed:S, '
+                      'uniform:MIN:MAX, exp:MEAN or lognormal:MU:SIGMA')
+    parser.add_option('-e', '--errors', dest='error_rate', type='float',
+                      default=0.0, help='Fraction of commands that fail')
+    parser.add_option('-s', '--output-lines', dest='output_lines',
+                      type='int', default=20,
+                      help='Lines of output per command')
+    parser.add_option('-n', '--iterations', dest='iterations', type='int',
+                      default=3, help='Fan-outs per output mode')
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                      default=None,
+                      help="Notch client concurrency (default: the "
+                      "client's own)")
+    parser.add_option('-m', '--modes', dest='modes',
+                      default='text,buffered_text,csv,pager',
+                      help='Comma-separated output modes to benchmark')
+    parser.add_option('--command', dest='command',
+                      default='show interfaces description',
+                      help='The command sent to each device')
+    parser.add_option('-o', '--results', dest='results', default=RESULTS_FILE,
+                      help='Results file to append to (default: %default)')
+    parser.add_option('--seed', dest='seed', type='int', default=None,
+                      help='Random seed for the fake agent')
+    return parser
+
+
+def main():
+    options, _ = get_option_parser().parse_args()
+    try:
+        results = run(options)
+    except Error, e:
+        print >> sys.stderr, 'Benchmark aborted; no results recorded: %s' % e
+        raise SystemExit(1)
+    previous = load_previous(options.results, results['settings'])
+    f = open(options.results, 'a')
+    try:
+        f.write(json.dumps(results, sort_keys=True) + '\n')
+    finally:
+        f.close()
+    report(results, previous)
+
+
+if __name__ == '__main__':
+    main()
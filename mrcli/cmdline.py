@@ -20,21 +20,59 @@ The CommandLineInterface class provides an alternative to the cmd.Cmd class
 from the Python standard library, offering much the same interface.
 """
 
+import bisect
 import sys
 
-import pytrie
+try:
+    import readline
+except ImportError:
+    readline = None
 
 
 EOF_SENTINEL = '__EOF__'
 
 
+class CompletionIndex(object):
+    """A sorted vocabulary of words, for fast prefix lookups."""
+
+    def __init__(self, words=()):
+        self._words = sorted(set(words))
+
+    def __len__(self):
+        return len(self._words)
+
+    def matches(self, prefix):
+        """Returns the words starting with prefix, in sorted order."""
+        result = []
+        i = bisect.bisect_left(self._words, prefix)
+        while i < len(self._words) and self._words[i].startswith(prefix):
+            result.append(self._words[i])
+            i += 1
+        return result
+
+
 class CLI(object):
     """An abstract command-line interface or CLI.
 
     Attributes:
       menu: A dict, keyed by string, with string value. The key is
-        the command, and the value is appended to 'do_command_' to
-        find a method defined in your concrete subclass.
+        the command, and the value is the name of the method defined
+        in your concrete subclass that handles it.
+
+    Commands may be abbreviated to any prefix. Where a prefix matches
+    more than one command, the shortest command is used.
+
+    Arguments are completed by completers registered with
+    set_completer(). A completer is one of:
+      - a list of words,
+      - a dict of subcommand words, each mapped to the completer for
+        the following argument (or None), or
+      - a callable returning an iterable of words. Its words are
+        indexed on first use and cached until invalidate_completions()
+        is called.
+    A list or callable completer applies to every following argument.
+    List and dict completers (including those nested in dicts) are
+    indexed once, by set_completer(), so they must not be modified later.
     """
     HELP_COMMANDS = ('help', '?' '/help')
 
@@ -61,16 +99,83 @@ class CLI(object):
         self._reverse_menu = {}
         self._old_completer = None
         self._completer = None
+        # Argument completers, keyed by method name.
+        self._completers = {}
+        # id(completer) -> (completer, CompletionIndex), for list and dict
+        # completers. Holding the completer keeps its id from being reused.
+        self._static_indexes = {}
+        self._completion_cache = {}
+        self.completion_matches = []
         self._build_command_prefixes()
-   
+        for k, v in menu.iteritems():
+            if v == 'do_help':
+                self.set_completer(k, self._command_words)
+
+    def set_menu(self, menu):
+        """Replaces the menu, recompiling command lookups."""
+        self._menu = menu
+        self._build_command_prefixes()
+
     def _build_command_prefixes(self):
-        self._command_trie = pytrie.SortedStringTrie(self._menu)
+        # Map every prefix of every command to the method it selects;
+        # visiting the shortest commands first lets them win ties.
+        self._abbreviations = {}
+        for _, k in sorted((len(k), k) for k in self._menu):
+            for i in xrange(1, len(k) + 1):
+                self._abbreviations.setdefault(k[:i], self._menu[k])
         self._reverse_menu = {}
         for k, v in self._menu.iteritems():
             if v in self._reverse_menu:
                 self._reverse_menu[v].append(k)
             else:
                 self._reverse_menu[v] = [k]
+        self._command_index = CompletionIndex(
+            k for k in self._menu if not k.startswith('__'))
+        self.invalidate_completions()
+
+    def _command_words(self):
+        return self._command_index.matches('')
+
+    def set_completer(self, command, completer):
+        """Sets the argument completer for a menu command."""
+        self._completers[self._menu[command]] = completer
+        self._index_completer(completer)
+
+    def _index_completer(self, completer):
+        if isinstance(completer, dict):
+            for subcompleter in completer.itervalues():
+                self._index_completer(subcompleter)
+        if completer and not callable(completer):
+            self._static_indexes[id(completer)] = (
+                completer, CompletionIndex(completer))
+
+    def invalidate_completions(self):
+        """Discards the cached words of all callable completers."""
+        self._completion_cache = {}
+
+    def _index_for(self, completer):
+        if callable(completer):
+            if completer not in self._completion_cache:
+                self._completion_cache[completer] = CompletionIndex(
+                    completer())
+            return self._completion_cache[completer]
+        return self._static_indexes[id(completer)][1]
+
+    def completions(self, line, text):
+        """Returns the completions of 'text', the last word of 'line'."""
+        words = line.split()
+        if text:
+            words = words[:-1]
+        if not words:
+            return [m + ' ' for m in self._command_index.matches(text)]
+        completer = self._completers.get(self._abbreviations.get(words[0]))
+        for word in words[1:]:
+            if not isinstance(completer, dict):
+                break
+            completer = completer.get(word)
+        if not completer:
+            return []
+        return [m + ' ' for m in self._index_for(completer).matches(text)]
 
     def cmdloop(self, intro=None):
         self.preloop()
@@ -100,30 +205,17 @@ class CLI(object):
         """Return the next possible completion for 'text'.
 
         If a command has not been entered, then complete against command list.
-        Otherwise try to call complete_<command> to get list of completions.
+        Otherwise use the command's completer, if one is set.
         """
         if state <= 0:
-            orig_line = readline.get_line_buffer()
-            if orig_line[-1:] != '?':
-                line = orig_line.lstrip()
-                if not line:
-                    methods = self.get_docstrings_for_all().keys()
-                    self.completion_matches = [m.rstrip(' .')
-                                               for m in methods
-                                               if not m.startswith('__')]
-                else:
-                    methods = self.get_docstrings_for_matching_choices(
-                        self._command_trie.values(prefix=line.split()[0]))
+            line = readline.get_line_buffer()[:readline.get_endidx()]
+            if line[-1:] != '?':
+                self.completion_matches = self.completions(line, text)
             else:
                 self.stdout.write('\nMatching commands:\n')
-                self.stdout.write(self._build_help(orig_line))
+                self.stdout.write(self._build_help(line))
                 self.stdout.write('\n\nPress enter to continue.\n')
-
-                
-                
-            self.completion_matches = [m+' ' for m in methods
-                                       if (not m.startswith('__')
-                                           and m.startswith(line))]
+                self.completion_matches = []
         try:
             return self.completion_matches[state]
         except IndexError:
@@ -132,15 +224,15 @@ class CLI(object):
     def _setup_readline(self):
         if not self.completekey:
             return
-        try:
-            import readline
-        except ImportError:
+        if readline is None:
             # Readline is not available, so disable completion.
             self.completekey = None
             return
         else:
             self._old_completer = readline.get_completer()
             readline.set_completer(self.complete)
+            # Device names contain '-' and '.', and lists are comma separated.
+            readline.set_completer_delims(' \t\n,')
             readline.parse_and_bind('?: "\C-v?\t\d"')
             readline.parse_and_bind(self.completekey+": complete")
 
@@ -186,16 +278,10 @@ class CLI(object):
             return self.emptyline()
         else:
             # Only check the first-word.
-            matches = self._command_trie.keys(prefix=line.split()[0])
-            if not matches or not len(matches):
+            choice = self._abbreviations.get(line.split()[0])
+            if choice is None:
                 return self.default(line)
-            elif len(matches) == 1:
-                choice = self._command_trie.longest_prefix_value(matches[0])
-                return getattr(self, choice)(line)
-            elif len(matches) > 1:
-                # Use the shortest common prefix.
-                _, match = sorted([(len(m), m) for m in matches])[0]
-                choice = self._command_trie.longest_prefix_value(match)
+            else:
                 return getattr(self, choice)(line)
 
     def get_docstrings_for_matching_choices(self, choices):
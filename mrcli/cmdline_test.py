@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the cmdline module."""
+
+import StringIO
+import unittest
+
+import cmdline
+
+
+class CompletionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cli = cmdline.CLI({'help': 'do_help', 'output': 'do_output',
+                                'until': 'do_until', 'targets': 'do_targets'},
+                               stdout=StringIO.StringIO())
+        self.cli.set_completer('output', ['text', 'csv', 'pager'])
+        self.cli.set_completer('until', {'match': None,
+                                         'quorum': ['50%', '90%']})
+        self.words = ['ar1.syd', 'ar2.syd']
+        self.calls = 0
+        self.cli.set_completer('targets', self.device_names)
+
+    def device_names(self):
+        self.calls += 1
+        return self.words
+
+    def testCommands(self):
+        self.assertEqual(['targets '], self.cli.completions('t', 't'))
+        self.assertEqual(['until '], self.cli.completions('help u', 'u'))
+
+    def testList(self):
+        self.assertEqual(['csv '], self.cli.completions('out c', 'c'))
+        # A list applies to every following argument.
+        self.assertEqual(['csv ', 'pager ', 'text '],
+                         self.cli.completions('o text ', ''))
+
+    def testNestedDicts(self):
+        self.assertEqual(['match '], self.cli.completions('until m', 'm'))
+        self.assertEqual(['90% '], self.cli.completions('until quorum 9', '9'))
+        self.assertEqual([], self.cli.completions('until match x', 'x'))
+
+    def testStaticIndexesAreBuiltOnce(self):
+        index = self.cli._index_for(self.cli._completers['do_output'])
+        self.cli.completions('out c', 'c')
+        self.assertTrue(
+            index is self.cli._index_for(self.cli._completers['do_output']))
+
+    def testCallableCachedUntilInvalidated(self):
+        self.assertEqual(['ar1.syd '], self.cli.completions('t ar1', 'ar1'))
+        self.words = ['ar1.syd', 'ar1.mel']
+        self.cli.completions('t ar1', 'ar1')
+        self.assertEqual(1, self.calls)
+        self.cli.invalidate_completions()
+        self.assertEqual(['ar1.mel ', 'ar1.syd '],
+                         self.cli.completions('t ar1', 'ar1'))
+        self.assertEqual(2, self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A stand-in Notch Agent for benchmarking.
+
+Serves the devices_matching, devices_info and command methods of the
+Notch JSON-RPC API for a set of imaginary devices, with configurable
+latency, error rate and output size. No routers are contacted.
+
+This module deliberately does not import notch.client (which monkey
+patches the socket module), so that it can be run as a separate process:
+
+  $ python fakeagent.py --port 8800 --devices 2000 --latency exp:0.5
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import json
+import optparse
+import random
+import re
+import socket
+import sys
+import time
+
+
+# The JSON-RPC handler path used by the Notch client.
+PATH = '/JSONRPC2'
+
+DEVICE_TYPES = ('cisco_ios', 'juniper', 'cisco_ios', 'timos', 'cisco_ios')
+SITES = ('mel', 'syd', 'bne', 'per', 'adl')
+
+# Error code for CommandError (see notch.client.errors.error_dictionary).
+COMMAND_ERROR = 10
+# JSON-RPC method not found.
+METHOD_NOT_FOUND = -32601
+
+# Linux only.
+TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', None)
+
+
+class Error(Exception):
+    """A latency specification is invalid."""
+
+
+def parse_latency(spec):
+    """Parses a latency distribution into a callable returning seconds.
+
+    Distributions are 'fixed:S', 'uniform:MIN:MAX', 'exp:MEAN' or
+    'lognormal:MU:SIGMA'.
+    """
+    parts = spec.split(':')
+    try:
+        args = [float(p) for p in parts[1:]]
+        if parts[0] == 'fixed' and len(args) == 1:
+            return lambda: args[0]
+        elif parts[0] == 'uniform' and len(args) == 2:
+            return lambda: random.uniform(args[0], args[1])
+        elif parts[0] == 'exp' and len(args) == 1:
+            return lambda: random.expovariate(1.0 / args[0])
+        elif parts[0] == 'lognormal' and len(args) == 2:
+            return lambda: random.lognormvariate(args[0], args[1])
+    except (ValueError, ZeroDivisionError):
+        pass
+    raise Error('Invalid latency distribution %r' % spec)
+
+
+class Inventory(object):
+    """The imaginary devices served by the agent."""
+
+    def __init__(self, devices, output_lines):
+        self.names = ['bench%05d.%s' % (i, SITES[i % len(SITES)])
+                      for i in xrange(devices)]
+        self.info = {}
+        for i, name in enumerate(self.names):
+            device_type = DEVICE_TYPES[i % len(DEVICE_TYPES)]
+            self.info[name] = {'device_name': name,
+                               'device_type': device_type,
+                               'addresses': ['192.0.2.%d' % (i % 254 + 1)]}
+        self.output = '\n'.join(
+            'GigabitEthernet0/%-4d up             up       bench link %d'
+            % (i, i) for i in xrange(output_lines)) + '\n'
+
+    def matching(self, regexp):
+        r = re.compile(regexp)
+        return [n for n in self.names if r.match(n)]
+
+
+class FakeAgent(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server answering Notch JSON-RPC requests."""
+
+    daemon_threads = True
+    # Allow the burst of connections from a wide fan-out.
+    request_queue_size = 1024
+
+    def __init__(self, address, inventory, latency, error_rate):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.inventory = inventory
+        self.latency = latency
+        self.error_rate = error_rate
+
+    def devices_matching(self, regexp=None):
+        return self.inventory.matching(regexp or '^.*$')
+
+    def devices_info(self, regexp=None):
+        info = self.inventory.info
+        return dict((n, info[n]) for n in
+                    self.inventory.matching(regexp or '^.*$'))
+
+    def command(self, device_name=None, command=None, mode=None):
+        time.sleep(max(0.0, self.latency()))
+        if device_name not in self.inventory.info:
+            raise _RpcError(COMMAND_ERROR, 'No such device %r' % device_name)
+        if random.random() < self.error_rate:
+            raise _RpcError(COMMAND_ERROR, 'Simulated command error')
+        return base64.b64encode('%s# %s\n%s' % (device_name, command,
+                                                self.inventory.output))
+
+
+class _RpcError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, without Nagle delays, so that
+    # responses take the configured latency rather than the delayed-ACK
+    # timer.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    methods = ('devices_matching', 'devices_info', 'command')
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if self.path != PATH:
+            self.send_error(404)
+            return
+        if TCP_QUICKACK is not None:
+            # The client sends its headers and body in separate writes,
+            # so acknowledge the headers now rather than leaving the
+            # body waiting on the delayed-ACK timer.
+            self.connection.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        request = json.loads(body)
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            if request.get('method') not in self.methods:
+                raise _RpcError(METHOD_NOT_FOUND, 'Method not found')
+            method = getattr(self.server, request['method'])
+            params = request.get('params') or {}
+            if isinstance(params, dict):
+                params = dict((str(k), v) for k, v in params.iteritems())
+                response['result'] = method(**params)
+            else:
+                response['result'] = method(*params)
+        except _RpcError, e:
+            response['error'] = {'code': e.code, 'message': str(e)}
+        data = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def get_option_parser():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', dest='port', type='int', default=0,
+                      help='Port to listen on (0 picks a free port)')
+    parser.add_option('-d', '--devices', dest='devices', type='int',
+                      default=1000, help='Number of devices')
+    parser.add_option('-l', '--latency', dest='latency', default='fixed:0',
+                      help='Command latency distribution: fixed:S, '
+                      'uniform:MIN:MAX, exp:MEAN or lognormal:MU:SIGMA')
+    parser.add_option('-e', '--errors', dest='error_rate', type='float',
+                      default=0.0, help='Fraction of commands that fail')
+    parser.add_option('-s', '--output-lines', dest='output_lines',
+                      type='int', default=20,
+                      help='Lines of output per command')
+    parser.add_option('--seed', dest='seed', type='int', default=None,
+                      help='Random seed')
+    return parser
+
+
+def main(argv=None):
+    options, _ = get_option_parser().parse_args(argv)
+    random.seed(options.seed)
+    try:
+        latency = parse_latency(options.latency)
+    except Error, e:
+        print >> sys.stderr, str(e)
+        raise SystemExit(1)
+    agent = FakeAgent(('127.0.0.1', options.port),
+                      Inventory(options.devices, options.output_lines),
+                      latency, options.error_rate)
+    # The parent process reads the port from the first line.
+    print agent.server_address[1]
+    sys.stdout.flush()
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
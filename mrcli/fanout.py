@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Book-keeping for a single command fan-out.
+
+A FanOut is the set of requests sent for one command. Its targets may be
+split into waves (see split_waves), each of which is sent, waited upon and
+reported separately. A StopPolicy ends a fan-out early, once enough
+responses are in hand.
+"""
+
+import math
+import re
+import time
+
+
+class Error(Exception):
+    """A wave specification or stop policy is invalid."""
+
+
+REST = 'rest'
+
+
+def parse_wave_spec(spec):
+    """Parses a comma-separated wave specification.
+
+    Each wave is a device count ('50'), a percentage of all targets ('10%')
+    or 'rest'.
+
+    Returns:
+      A list of strings, one per wave.
+
+    Raises:
+      Error: The specification is invalid.
+    """
+    waves = [w.strip() for w in spec.split(',') if w.strip()]
+    if not waves:
+        raise Error('No waves supplied')
+    for w in waves:
+        if w == REST:
+            continue
+        try:
+            if w.endswith('%'):
+                size = float(w[:-1])
+                if not 0 < size <= 100:
+                    raise ValueError
+            else:
+                size = int(w)
+                if size < 1:
+                    raise ValueError
+        except ValueError:
+            raise Error('Invalid wave size %r' % w)
+    if REST in waves[:-1]:
+        raise Error('%r may only be the last wave' % REST)
+    return waves
+
+
+def split_waves(targets, waves):
+    """Splits a target list into waves.
+
+    Args:
+      targets: A list of device names.
+      waves: A list of wave sizes, as returned by parse_wave_spec.
+
+    Returns:
+      A list of non-empty target lists. Targets not covered by the wave
+      sizes form a final wave.
+    """
+    result = []
+    start = 0
+    total = len(targets)
+    for w in waves:
+        if start >= total:
+            break
+        if w == REST:
+            size = total - start
+        elif w.endswith('%'):
+            size = max(1, int(math.ceil(total * float(w[:-1]) / 100.0)))
+        else:
+            size = int(w)
+        result.append(targets[start:start+size])
+        start += size
+    if start < total:
+        result.append(targets[start:])
+    return result
+
+
+class StopPolicy(object):
+    """Decides when a fan-out has enough responses to stop.
+
+    Attributes:
+      kind: One of MATCH, COUNT or QUORUM.
+      value: The regexp (MATCH), number of responses (COUNT) or
+        fraction of targets (QUORUM) required.
+    """
+
+    # Stop at the first result matching a regexp.
+    MATCH = 'match'
+    # Stop after a number of successful responses.
+    COUNT = 'count'
+    # Stop after a percentage of targets respond successfully.
+    QUORUM = 'quorum'
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+        self._regexp = None
+        if kind == self.MATCH:
+            self._regexp = re.compile(value, re.MULTILINE)
+
+    def __str__(self):
+        if self.kind == self.QUORUM:
+            return '%s %.0f%%' % (self.kind, self.value * 100)
+        else:
+            return '%s %s' % (self.kind, self.value)
+
+    def satisfied(self, fanout, request):
+        """Returns True if the fan-out can stop after this request."""
+        if request.error is not None or request.result is None:
+            return False
+        if self.kind == self.MATCH:
+            return self._regexp.search(request.result) is not None
+        ok = fanout.done - fanout.errors
+        if self.kind == self.COUNT:
+            return ok >= self.value
+        else:
+            return ok >= math.ceil(len(fanout.targets) * self.value)
+
+
+def parse_stop_policy(spec):
+    """Parses a stop policy, e.g., 'match 00:1b:2c', 'count 50' or
+    'quorum 10%'.
+
+    Returns:
+      A StopPolicy.
+
+    Raises:
+      Error: The policy is invalid.
+    """
+    kind, _, value = spec.strip().partition(' ')
+    value = value.strip()
+    if not value:
+        raise Error('The %r policy requires a value' % kind)
+    try:
+        if kind == StopPolicy.MATCH:
+            return StopPolicy(kind, value)
+        elif kind == StopPolicy.COUNT:
+            count = int(value)
+            if count < 1:
+                raise ValueError
+            return StopPolicy(kind, count)
+        elif kind == StopPolicy.QUORUM:
+            quorum = float(value.rstrip('%'))
+            if not 0 < quorum <= 100:
+                raise ValueError
+            return StopPolicy(kind, quorum / 100.0)
+    except ValueError:
+        raise Error('Invalid value %r for the %r policy' % (value, kind))
+    except re.error, e:
+        raise Error('Invalid regexp %r: %s' % (value, str(e)))
+    raise Error('Unknown stop policy %r' % kind)
+
+
+class Wave(object):
+    """A group of requests sent together.
+
+    Attributes:
+      index: The wave number, starting at 1.
+      targets: The device names in this wave.
+      timeout: The deadline (in seconds) for requests in this wave.
+      requests: The requests sent in this wave.
+      gts: Handles returned by the Notch client for each request, in the
+        same order as requests.
+      done: The number of requests that have completed.
+      errors: The number of requests that completed with an error.
+      cancelled: The number of requests cancelled before completing.
+      expired: True once the wave's deadline has passed.
+      reported: True once the wave's summary has been displayed.
+    """
+
+    def __init__(self, index, targets, timeout):
+        self.index = index
+        self.targets = targets
+        self.timeout = timeout
+        self.requests = []
+        self.gts = []
+        self.done = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.expired = False
+        self.reported = False
+
+    def __len__(self):
+        return len(self.targets)
+
+    def finished(self):
+        return self.done >= len(self.targets)
+
+    def settled(self):
+        """Returns the number of requests no longer outstanding."""
+        return self.done + self.cancelled
+
+    def error_rate(self):
+        if not self.done:
+            return 0.0
+        return float(self.errors) / self.done
+
+
+class FanOut(object):
+    """The requests sent for a single command.
+
+    Attributes:
+      command: The command sent.
+      targets: All targets of the command.
+      id: The archive's fan-out identifier, if recording.
+      started: When the fan-out started (seconds since the epoch).
+      waves: The Wave objects sent so far.
+      policy: None, or the StopPolicy ending this fan-out early.
+      stopped: True once the stop policy has been satisfied.
+      finished: True once the fan-out is no longer waiting on requests.
+      cancelled: The number of requests cancelled before completing.
+      done: The number of requests that have completed.
+      errors: The number of requests that completed with an error.
+    """
+
+    def __init__(self, command, targets, id=None, policy=None):
+        self.command = command
+        self.targets = targets
+        self.id = id
+        self.policy = policy
+        self.started = time.time()
+        self.waves = []
+        self.stopped = False
+        self.finished = False
+        self.cancelled = 0
+        self.done = 0
+        self.errors = 0
+        # Requests cancelled before completing.
+        self._cancelled = set()
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def add_wave(self, targets, timeout):
+        wave = Wave(len(self.waves) + 1, targets, timeout)
+        self.waves.append(wave)
+        return wave
+
+    def completed(self, request, wave=None):
+        """Records the completion of a request (called from callbacks).
+
+        Callbacks run in the Notch client's green threads, so no locking
+        is required.
+
+        Returns:
+          True if this request satisfied the stop policy.
+        """
+        self.done += 1
+        if request.error is not None:
+            self.errors += 1
+        if wave is not None:
+            wave = self.waves[wave - 1]
+            wave.done += 1
+            if request.error is not None:
+                wave.errors += 1
+        if (self.policy is not None and not self.stopped
+            and self.policy.satisfied(self, request)):
+            self.stopped = True
+            return True
+        return False
+
+    def cancel(self, wave, request):
+        """Records that a request was cancelled before completing.
+
+        The Notch client still calls back for a cancelled request (with
+        RequestCancelledError as its error), so callbacks check
+        is_cancelled() to avoid counting it again.
+        """
+        self._cancelled.add(request)
+        self.cancelled += 1
+        wave.cancelled += 1
+
+    def is_cancelled(self, request):
+        return request in self._cancelled
+
+    def sent(self):
+        """Returns the number of requests sent."""
+        return sum(len(wave.requests) for wave in self.waves)
+
+    def pending(self):
+        """Returns (wave, request, handle) for uncompleted requests."""
+        result = []
+        for wave in self.waves:
+            result.extend((wave, r, gt)
+                          for r, gt in zip(wave.requests, wave.gts)
+                          if not (r.completed or r in self._cancelled))
+        return result
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the fanout module."""
+
+import unittest
+
+import fanout
+
+
+class FakeRequest(object):
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+
+    completed = property(lambda self: (self.result is not None or
+                                       self.error is not None))
+
+
+class WaveSpecTest(unittest.TestCase):
+
+    def testParse(self):
+        self.assertEqual(['1%', '10', 'rest'],
+                         fanout.parse_wave_spec(' 1%, 10,rest'))
+
+    def testInvalid(self):
+        for spec in ('', '0', '-5', '0%', '101%', 'ten', 'rest,10'):
+            self.assertRaises(fanout.Error, fanout.parse_wave_spec, spec)
+
+    def testSplitCounts(self):
+        targets = range(10)
+        self.assertEqual([[0], [1, 2, 3], range(4, 10)],
+                         fanout.split_waves(targets, ['1', '3', 'rest']))
+
+    def testSplitPercentagesRoundUp(self):
+        targets = range(10)
+        self.assertEqual([[0], [1, 2, 3, 4], range(5, 10)],
+                         fanout.split_waves(targets, ['1%', '40%']))
+
+    def testSplitShortTargetList(self):
+        self.assertEqual([[0, 1]], fanout.split_waves([0, 1], ['5', 'rest']))
+        self.assertEqual([], fanout.split_waves([], ['5', 'rest']))
+
+
+class FanOutTest(unittest.TestCase):
+
+    def testCompletedCountsPerWave(self):
+        fo = fanout.FanOut('show ver', ['a', 'b', 'c'])
+        fo.add_wave(['a'], 10.0)
+        wave = fo.add_wave(['b', 'c'], 10.0)
+        fo.completed(FakeRequest(result='ok'), 2)
+        fo.completed(FakeRequest(error=Exception('x')), 2)
+        self.assertEqual((2, 1), (fo.done, fo.errors))
+        self.assertEqual((2, 1), (wave.done, wave.errors))
+        self.assertEqual(0, fo.waves[0].done)
+        self.assertTrue(wave.finished())
+        self.assertEqual(0.5, wave.error_rate())
+
+    def testSettledIncludesCancelled(self):
+        fo = fanout.FanOut('show ver', ['a', 'b'])
+        wave = fo.add_wave(['a', 'b'], 10.0)
+        fo.completed(FakeRequest(result='ok'), 1)
+        cancelled = FakeRequest()
+        wave.requests, wave.gts = [cancelled], ['gt-b']
+        fo.cancel(wave, cancelled)
+        self.assertTrue(fo.is_cancelled(cancelled))
+        self.assertEqual((1, 1), (fo.cancelled, wave.cancelled))
+        self.assertEqual(2, wave.settled())
+        self.assertFalse(wave.finished())
+        self.assertEqual([], fo.pending())
+
+    def testPending(self):
+        fo = fanout.FanOut('show ver', ['a', 'b'])
+        wave = fo.add_wave(['a', 'b'], 10.0)
+        done, waiting = FakeRequest(result='ok'), FakeRequest()
+        wave.requests = [done, waiting]
+        wave.gts = ['gt-a', 'gt-b']
+        self.assertEqual([(wave, waiting, 'gt-b')], fo.pending())
+        self.assertEqual(2, fo.sent())
+
+
+class StopPolicyTest(unittest.TestCase):
+
+    def testParse(self):
+        policy = fanout.parse_stop_policy('match  00:1b:2c ')
+        self.assertEqual(('match', '00:1b:2c'), (policy.kind, policy.value))
+        self.assertEqual(50, fanout.parse_stop_policy('count 50').value)
+        policy = fanout.parse_stop_policy('quorum 10%')
+        self.assertEqual(0.1, policy.value)
+        self.assertEqual('quorum 10%', str(policy))
+
+    def testInvalid(self):
+        for spec in ('count', 'count 0', 'count x', 'quorum 0',
+                     'quorum 150%', 'match (', 'sometimes 5'):
+            self.assertRaises(fanout.Error, fanout.parse_stop_policy, spec)
+
+    def testMatchSearchesLines(self):
+        policy = fanout.parse_stop_policy('match ^Gi0/1 up')
+        fo = fanout.FanOut('show int', ['a'], policy=policy)
+        self.assertFalse(fo.completed(FakeRequest(result='Gi0/10 up\n')))
+        self.assertTrue(fo.completed(FakeRequest(result='x\nGi0/1 up\n')))
+        self.assertTrue(fo.stopped)
+
+    def testErrorsDoNotCount(self):
+        fo = fanout.FanOut('show ver', ['a', 'b', 'c'],
+                           policy=fanout.parse_stop_policy('count 2'))
+        self.assertFalse(fo.completed(FakeRequest(result='ok')))
+        self.assertFalse(fo.completed(FakeRequest(error=Exception('x'))))
+        self.assertTrue(fo.completed(FakeRequest(result='ok')))
+        # Only the first satisfying response reports the stop.
+        self.assertFalse(fo.completed(FakeRequest(result='ok')))
+
+    def testQuorumOfTargets(self):
+        fo = fanout.FanOut('show ver', ['t%d' % i for i in range(10)],
+                           policy=fanout.parse_stop_policy('quorum 25%'))
+        self.assertFalse(fo.completed(FakeRequest(result='ok')))
+        self.assertFalse(fo.completed(FakeRequest(result='ok')))
+        self.assertTrue(fo.completed(FakeRequest(result='ok')))
+
+
+if __name__ == '__main__':
+    unittest.main()
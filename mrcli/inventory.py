@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""The device inventory, for validating and selecting targets locally.
+
+An Inventory is built from a single devices_info poll of the agents, so
+that long target lists can be checked without a round trip per name or
+regular expression. Devices can also be selected by their attributes
+(e.g., 'type=cisco_ios site=mel'), using an inverted index per attribute.
+"""
+
+import re
+
+
+# Short names for device attributes in predicates.
+ALIASES = {'type': 'device_type'}
+# Separates alternative values in a predicate, e.g., 'type=juniper|timos'.
+VALUE_SEPARATOR = '|'
+
+
+def parse_predicate(spec):
+    """Parses an attribute predicate, e.g., 'type=juniper|timos'.
+
+    Returns:
+      A tuple (attribute, values), with aliases resolved.
+    """
+    attribute, _, values = spec.partition('=')
+    attribute = attribute.strip()
+    attribute = ALIASES.get(attribute, attribute)
+    return attribute, [v for v in values.split(VALUE_SEPARATOR) if v]
+
+
+def is_predicate(spec):
+    """Returns True if a target spec is an attribute predicate."""
+    return '=' in spec and not spec.startswith('^')
+
+
+def _site(device_name):
+    """Returns the site of a device, from its name (e.g., 'ar1.mel')."""
+    if '.' in device_name:
+        return device_name.rsplit('.', 1)[1]
+    return None
+
+
+class Inventory(object):
+    """The devices known to the agents.
+
+    Attributes:
+      devices: A dict keyed by device name, with a dict of the device's
+        attributes as value (as returned by devices_info).
+    """
+
+    # Attributes derived from the device name, where the agents don't
+    # supply them.
+    DERIVED = {'site': _site}
+
+    def __init__(self, devices):
+        self.devices = devices
+        self._sorted_names = None
+        # attribute -> {value: set(device names)}, built on first use.
+        self._indexes = {}
+
+    def __contains__(self, name):
+        return name in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def names(self):
+        """Returns all device names, sorted."""
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.devices)
+        return self._sorted_names
+
+    def matching(self, regexp):
+        """Returns the names matching regexp (anchored at the start).
+
+        Raises:
+          re.error: The regular expression is invalid.
+        """
+        match = re.compile(regexp).match
+        return [n for n in self.names() if match(n)]
+
+    def get(self, device_name, attribute, default=None):
+        """Returns an attribute of a device, or default."""
+        attribute = ALIASES.get(attribute, attribute)
+        info = self.devices.get(device_name)
+        if info and attribute in info:
+            return info[attribute]
+        elif info is not None and attribute in self.DERIVED:
+            value = self.DERIVED[attribute](device_name)
+            if value is not None:
+                return value
+        return default
+
+    def index(self, attribute):
+        """Returns the inverted index for an attribute.
+
+        Returns:
+          A dict keyed by attribute value (as a string), with the set of
+          device names having that value. Devices with a list of values
+          (e.g., addresses) appear under each.
+        """
+        attribute = ALIASES.get(attribute, attribute)
+        if attribute not in self._indexes:
+            index = {}
+            for name in self.devices:
+                value = self.get(name, attribute)
+                if value is None:
+                    continue
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                for v in value:
+                    if isinstance(v, dict):
+                        continue
+                    index.setdefault(str(v), set()).add(name)
+            self._indexes[attribute] = index
+        return self._indexes[attribute]
+
+    def attributes(self):
+        """Returns the names of all attributes of the devices, sorted."""
+        names = set(self.DERIVED)
+        for info in self.devices.itervalues():
+            if info:
+                names.update(info)
+        return sorted(names)
+
+    def select(self, predicates):
+        """Returns the names of devices matching all predicates.
+
+        Args:
+          predicates: A list of (attribute, values) tuples, as returned by
+            parse_predicate. A device matches if its attribute has any of
+            the values.
+
+        Returns:
+          A set of device names.
+        """
+        sets = []
+        for attribute, values in predicates:
+            index = self.index(attribute)
+            if len(values) == 1:
+                sets.append(index.get(values[0], set()))
+            else:
+                matched = set()
+                for v in values:
+                    matched.update(index.get(v, ()))
+                sets.append(matched)
+        if not sets:
+            return set(self.devices)
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def resolve(self, spec):
+        """Returns the device names for a target spec.
+
+        A spec starting with ^ is a regular expression and one containing
+        = is an attribute predicate; anything else is a device name.
+        Unknown names resolve to an empty list.
+
+        A spec may also be several whitespace-separated specs (see
+        read_specs). Its predicates must all match; they select from the
+        other specs, or from all devices if there are none.
+        """
+        specs = spec.split()
+        if len(specs) > 1 or is_predicate(spec):
+            selected = self.select([parse_predicate(s) for s in specs
+                                    if is_predicate(s)])
+            names = [s for s in specs if not is_predicate(s)]
+            if not names:
+                return sorted(selected)
+            result = []
+            for name in names:
+                result.extend(n for n in self.resolve(name) if n in selected)
+            return result
+        elif spec.startswith('^'):
+            try:
+                return self.matching(spec)
+            except re.error:
+                return []
+        elif spec in self.devices:
+            return [spec]
+        else:
+            return []
+
+
+def read_specs(f):
+    """Yields the target specs in a file, one line at a time.
+
+    Blank lines and lines starting with # are ignored. Lines starting
+    with ^ are regular expressions (not split on commas); other lines may
+    hold several device names separated by commas or whitespace. A line
+    with attribute predicates is yielded whole, so that (as with the
+    targets command) they are combined and select from the rest of the
+    line.
+    """
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('^'):
+            yield line
+            continue
+        specs = line.replace(',', ' ').split()
+        if [s for s in specs if is_predicate(s)]:
+            yield ' '.join(specs)
+        else:
+            for spec in specs:
+                yield spec
+
+
+def resolve_specs(specs, inventory, chunk_size, unknown):
+    """Yields lists of at most chunk_size validated device names.
+
+    Names are yielded as soon as a chunk fills, so callers can begin
+    using them while the remaining specs are still being read. Duplicate
+    names are dropped.
+
+    Args:
+      specs: An iterable of target specs (see Inventory.resolve).
+      inventory: The Inventory to validate against.
+      chunk_size: The maximum number of names per list.
+      unknown: A list, extended with specs that matched no devices.
+    """
+    seen = set()
+    chunk = []
+    for spec in specs:
+        names = inventory.resolve(spec)
+        if not names:
+            unknown.append(spec)
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                chunk.append(name)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
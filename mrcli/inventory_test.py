@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the inventory module."""
+
+import StringIO
+import unittest
+
+import inventory
+
+
+DEVICES = {
+    'a.syd': {'device_name': 'a.syd', 'device_type': 'juniper',
+              'addresses': ['192.0.2.1', '192.0.2.2']},
+    'b.syd': {'device_name': 'b.syd', 'device_type': 'cisco_ios',
+              'addresses': []},
+    'c.mel': {'device_name': 'c.mel', 'device_type': 'juniper',
+              'site': 'melbourne'},
+    }
+
+
+def resolve_file(inv, text, chunk_size=100):
+    unknown = []
+    chunks = list(inventory.resolve_specs(
+            inventory.read_specs(StringIO.StringIO(text)), inv, chunk_size,
+            unknown))
+    return chunks, unknown
+
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.inv = inventory.Inventory(DEVICES)
+
+    def testPredicates(self):
+        self.assertEqual(('device_type', ['juniper', 'timos']),
+                         inventory.parse_predicate('type=juniper|timos'))
+        self.assertTrue(inventory.is_predicate('site=syd'))
+        self.assertFalse(inventory.is_predicate('^a=b'))
+
+    def testGet(self):
+        self.assertEqual('juniper', self.inv.get('a.syd', 'type'))
+        self.assertEqual('syd', self.inv.get('a.syd', 'site'))
+        # Attributes from the agent take precedence over derived ones.
+        self.assertEqual('melbourne', self.inv.get('c.mel', 'site'))
+        self.assertEqual('?', self.inv.get('x.syd', 'type', '?'))
+
+    def testIndexListValues(self):
+        index = self.inv.index('addresses')
+        self.assertEqual(set(['a.syd']), index['192.0.2.2'])
+
+    def testSelectIntersects(self):
+        select = self.inv.select
+        self.assertEqual(set(['a.syd']),
+                         select([('device_type', ['juniper']),
+                                 ('site', ['syd'])]))
+        self.assertEqual(set(['a.syd', 'b.syd', 'c.mel']),
+                         select([('device_type', ['juniper', 'cisco_ios'])]))
+        self.assertEqual(set(), select([('colour', ['red'])]))
+        self.assertEqual(set(DEVICES), select([]))
+
+    def testSelectDoesNotShareIndexSets(self):
+        self.inv.select([('device_type', ['juniper'])]).clear()
+        self.assertEqual(2, len(self.inv.index('type')['juniper']))
+
+    def testResolve(self):
+        self.assertEqual(['a.syd'], self.inv.resolve('a.syd'))
+        self.assertEqual([], self.inv.resolve('z.syd'))
+        self.assertEqual(['a.syd', 'b.syd'], self.inv.resolve('^.*syd'))
+        self.assertEqual([], self.inv.resolve('^('))
+        self.assertEqual(['a.syd', 'c.mel'], self.inv.resolve('type=juniper'))
+
+
+class TargetFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.inv = inventory.Inventory(DEVICES)
+
+    def testReadSpecs(self):
+        text = ('# comment\n\na.syd, b.syd\n^c{1,2}\\.(mel|syd)$ \n'
+                'type=juniper, site=syd\n')
+        self.assertEqual(['a.syd', 'b.syd', '^c{1,2}\\.(mel|syd)$',
+                          'type=juniper site=syd'],
+                         list(inventory.read_specs(StringIO.StringIO(text))))
+
+    def testPredicateLineIntersects(self):
+        # As 'targets type=juniper site=syd' would.
+        chunks, _ = resolve_file(self.inv, 'type=juniper site=syd\n')
+        self.assertEqual([['a.syd']], chunks)
+
+    def testPredicatesFilterLine(self):
+        chunks, _ = resolve_file(self.inv, '^.*syd type=juniper\n')
+        self.assertEqual([['a.syd']], chunks)
+        chunks, _ = resolve_file(self.inv, 'a.syd,b.syd type=juniper\n')
+        self.assertEqual([['a.syd']], chunks)
+
+    def testChunksDuplicatesAndUnknown(self):
+        chunks, unknown = resolve_file(
+            self.inv, 'a.syd\nz.syd\n^.*syd\ntype=timos\nc.mel\n', 2)
+        self.assertEqual([['a.syd', 'b.syd'], ['c.mel']], chunks)
+        self.assertEqual(['z.syd', 'type=timos'], unknown)
+
+
+if __name__ == '__main__':
+    unittest.main()
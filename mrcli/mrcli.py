@@ -26,20 +26,45 @@ tool for planned events as well as diagnosis during break fix.
 """
 
 
+import httplib
+import itertools
 import logging
+import math
 import optparse
 import os
+import re
+import socket
 import sys
 import threading
+import time
 
 try:
     import netmunge
 except ImportError:
     netmunge = None
 
+import eventlet.queue
+import jsonrpclib
 import notch.client
 
+import archive
 import cmdline
+import fanout
+import inventory
+import pager
+
+
+# Exceptions a request's green thread can end with before the Notch
+# client runs its callback. When an agent returns a JSON-RPC error, the
+# client's error handling makes a further (failing) RPC, which raises
+# one of these out of the green thread.
+CLIENT_FAILURES = (jsonrpclib.ProtocolError, socket.error,
+                   httplib.HTTPException)
+# Exceptions raised by synchronous agent queries (such as devices_info):
+# client errors, errors returned by the agent (which have their own
+# base class) and the failures above.
+AGENT_ERRORS = ((notch.client.Error, notch.client.errors.Error)
+                + CLIENT_FAILURES)
 
 
 class MisterCLI(cmdline.CLI):
@@ -49,9 +74,21 @@ class MisterCLI(cmdline.CLI):
     HELP_INTRODUCTION = 'Mr. CLI command-line interface help.'
     PREFIX = 'mr.cli'
     PROMPT = '%s [t: 0] > ' % PREFIX
+    # The fraction of a wave that must complete before the next is sent.
+    WAVE_ADVANCE = 0.9
+    # How often (in seconds) waits check for requests that failed
+    # without a callback.
+    REAP_INTERVAL = 0.1
+    # The number of validated targets sent as each wave of a target file.
+    TARGET_CHUNK = 500
+    # Lines of each device's result shown by the pager output mode.
+    PAGER_LINES = 40
+    # Attributes offered as predicates (e.g., 'type=juniper') by targets
+    # completion.
+    COMPLETED_ATTRIBUTES = ('type', 'site')
 
     def __init__(self, notch, completekey='tab', stdin=None, stdout=None,
-                 targets=None):
+                 targets=None, recorder=None, replay=None):
         menu = {r'exit': 'do_exit',
                 r'quit': 'do_exit',
                 r'help': 'do_help',
@@ -62,6 +99,12 @@ class MisterCLI(cmdline.CLI):
                 r'targets': 'do_targets',
                 r'timeout': 'do_timeout',
                 r'matches': 'do_matches',
+                r'record': 'do_record',
+                r'replay': 'do_replay',
+                r'waves': 'do_waves',
+                r'until': 'do_until',
+                r'cancel': 'do_cancel',
+                r'expand': 'do_expand',
                 }
         super(MisterCLI, self).__init__(menu, completekey=completekey,
                                         stdin=stdin, stdout=stdout)
@@ -69,23 +112,54 @@ class MisterCLI(cmdline.CLI):
         self.from_cmd_loop = True
         self.notch = notch
         self.targets = []
+        # Target files (or '-' for stdin) streamed by the next command.
+        self.target_files = None
+        # Session archives; see do_record and do_replay.
+        self.recorder = recorder
+        self.replay = replay
+        # The current (or last) command fan-out.
+        self.fanout = None
+        # Callbacks wake _wait_wave through this queue.
+        self._progress = eventlet.queue.LightQueue()
+        # Wave execution; see do_waves.
+        self.waves = None
+        self.wave_timeout = None
+        self.wave_errors = None
+        # Early termination; see do_until.
+        self.until = None
+        # If set, Ctrl-C only cancels requests pending for this many seconds.
+        self.cancel_after = None
 
-        if targets:
-            for t in targets:
-                if t.startswith('^'):
-                    self.targets.extend(
-                        self._complete_targets([t], only_regexp=True))
-                else:
-                    self.targets.append(t)
         self.timeout = 90.0
         self.banned_commands = ('rel', 'reb', 'conf') # reload / reboot / config
 
         self._devices = {}
+        # The inventory built from _devices; see _get_inventory.
+        self.inventory = None
+        if targets:
+            self.targets = self._complete_targets(targets)
         # The output mode (plugin) used.
         self.output_mode = None
         # Output buffers used by buffering output routines.
         self.output_buffers = {}
         self.output_done = threading.Event()
+        # The pager output mode's running pager, and the full results of
+        # its last fan-out; see do_expand.
+        self.pager = None
+        self.spill = None
+        self._unpaged_stdout = None
+
+        self.set_completer('targets', self._device_names)
+        self.set_completer('output', self._available_output_modes())
+        self.set_completer('record', {'off': None})
+        self.set_completer('replay', {'off': None})
+        self.set_completer('waves', {'off': None})
+        self.set_completer('until', {fanout.StopPolicy.MATCH: None,
+                                     fanout.StopPolicy.COUNT: None,
+                                     fanout.StopPolicy.QUORUM: None,
+                                     'off': None})
+        self.set_completer('cancel', {'all': None, 'slower': None})
+        self.set_completer('expand', self._spilled_device_names)
 
     def _command_is_bad(self, line):
         if line in self.banned_commands:
@@ -110,7 +184,12 @@ class MisterCLI(cmdline.CLI):
         if self._command_is_bad(line):
             self.stdout.write('*** The command %r is disallowed.\n\n' % line)
         else:
-            self._execute_command(line, output_method=self.output_mode)
+            try:
+                self._execute_command(line, output_method=self.output_mode)
+            except AGENT_ERRORS, e:
+                # E.g., the inventory poll for csv output or target files.
+                self.stdout.write('*** Command failed: %s: %s\n\n'
+                                  % (e.__class__.__name__, str(e)))
 
     def _output_mode_is_ok(self, mode):
         if hasattr(self, '_output_' + mode):
@@ -120,11 +199,26 @@ class MisterCLI(cmdline.CLI):
                     '*** csv output mode unavailable '
                     '(netmunge module required)\n\n')
                 return False
+            elif mode == 'pager' and not self.from_cmd_loop:
+                self.stdout.write(
+                    '*** pager output mode is only available '
+                    'interactively\n\n')
+                return False
             else:
                 return True
         self.stdout.write('*** Unknown output mode.\n\n')
         return False
 
+    def _available_output_modes(self):
+        modes = []
+        for name in dir(self):
+            if (name.startswith('_output_') and
+                name != '_output_mode_is_ok'):
+                modes.append(name[len('_output_'):])
+        if netmunge is None:
+            modes.remove('csv')
+        return modes
+
     def do_output(self, line):
         """Sets the current output method.
 
@@ -134,6 +228,9 @@ class MisterCLI(cmdline.CLI):
 
           > output text    [note: default]
 
+          > output pager   [note: results are shown in $PAGER, long
+                            results truncated; see 'expand']
+
           > output ...
 
         """
@@ -170,7 +267,11 @@ class MisterCLI(cmdline.CLI):
                     (ok) or with an error (error). Data refers to the
                     volume of (result) responses received.
         """
-        self.stdout.write(str(self.notch.counters)+'\n')
+        if self.notch is None:
+            self.stdout.write('No agents; replaying from %s.\n'
+                              % self.replay.path)
+        else:
+            self.stdout.write(str(self.notch.counters)+'\n')
 
     def do_exit(self, _):
         """Exits Mr. CLI."""
@@ -201,6 +302,243 @@ class MisterCLI(cmdline.CLI):
             else:
                 self.stdout.write('No targets matched your query.\n')
 
+    def do_record(self, line):
+        """Records every command's results to an archive file.
+
+        Results are appended, so an existing archive can be extended.
+        Supply 'off' to stop recording, or no argument to see the
+        current archive.
+
+          > record /var/tmp/incident-42.mra
+          Recording to: /var/tmp/incident-42.mra
+
+          > record off
+          Stopped recording to: /var/tmp/incident-42.mra
+        """
+        args = line.split()
+        if len(args) < 2:
+            if self.recorder is None:
+                self.stdout.write('Not recording.\n')
+            else:
+                self.stdout.write('Recording to: %s\n' % self.recorder.path)
+        elif args[1] == 'off':
+            if self.recorder is not None:
+                self.recorder.close()
+                self.stdout.write('Stopped recording to: %s\n'
+                                  % self.recorder.path)
+                self.recorder = None
+        else:
+            try:
+                recorder = archive.Archive(args[1], writable=True)
+            except archive.Error, e:
+                self.stdout.write('*** Cannot record: %s\n\n' % str(e))
+            else:
+                if self.recorder is not None:
+                    self.recorder.close()
+                self.recorder = recorder
+                self.stdout.write('Recording to: %s\n' % recorder.path)
+
+    def do_replay(self, line):
+        """Serves commands from a recorded archive instead of the agents.
+
+        While replaying, 'cmd', 'matches' and 'targets' use the
+        latest recorded result for each device and command. Supply
+        'off' to return to the agents.
+
+          > replay /var/tmp/incident-42.mra
+          Replaying from: /var/tmp/incident-42.mra (2 devices)
+
+          > replay off
+          Stopped replaying from: /var/tmp/incident-42.mra
+        """
+        args = line.split()
+        if len(args) < 2:
+            if self.replay is None:
+                self.stdout.write('Not replaying.\n')
+            else:
+                self.stdout.write('Replaying from: %s\n' % self.replay.path)
+        elif args[1] == 'off':
+            if self.replay is not None:
+                if self.notch is None:
+                    self.stdout.write('*** No agents; cannot leave '
+                                      'offline mode.\n\n')
+                    return
+                self.replay.close()
+                self.stdout.write('Stopped replaying from: %s\n'
+                                  % self.replay.path)
+                self.replay = None
+                self._devices = {}
+                self.invalidate_completions()
+        else:
+            try:
+                replay = archive.Archive(args[1])
+            except archive.Error, e:
+                self.stdout.write('*** Cannot replay: %s\n\n' % str(e))
+            else:
+                if self.replay is not None:
+                    self.replay.close()
+                self.replay = replay
+                self._devices = {}
+                self.invalidate_completions()
+                self.stdout.write('Replaying from: %s (%d devices)\n'
+                                  % (replay.path,
+                                     len(replay.device_names())))
+
+    def do_waves(self, line):
+        """Displays or sets wave execution for large target lists.
+
+        Supply comma-separated wave sizes, either device counts,
+        percentages of the targets or 'rest'. Each wave is sent once
+        most of the previous wave has completed. Optionally supply a
+        per-wave timeout, and an error rate above which no further
+        waves are sent. Supply 'off' to send to all targets at once.
+
+          > waves 1%,10%,rest timeout=30 errors=20%
+          Waves: 1%, 10%, rest (timeout 30.0 s, stop above 20% errors)
+
+          > waves off
+          Waves disabled.
+        """
+        args = line.split()
+        if len(args) < 2:
+            pass
+        elif args[1] == 'off':
+            self.waves = self.wave_timeout = self.wave_errors = None
+        else:
+            try:
+                waves = fanout.parse_wave_spec(args[1])
+                wave_timeout = wave_errors = None
+                for arg in args[2:]:
+                    key, _, value = arg.partition('=')
+                    if key == 'timeout':
+                        wave_timeout = float(value)
+                        if wave_timeout < 1.0:
+                            raise fanout.Error(
+                                '1 second is the minimum timeout')
+                    elif key == 'errors':
+                        wave_errors = float(value.rstrip('%')) / 100.0
+                    else:
+                        raise fanout.Error('Unknown wave option %r' % arg)
+            except (fanout.Error, ValueError), e:
+                self.stdout.write('Error: %s\n' % str(e))
+                return
+            self.waves = waves
+            self.wave_timeout = wave_timeout
+            self.wave_errors = wave_errors
+        if not self.waves:
+            self.stdout.write('Waves disabled.\n')
+        else:
+            options = ['timeout %.1f s' % (self.wave_timeout or self.timeout)]
+            if self.wave_errors is not None:
+                options.append('stop above %.0f%% errors'
+                               % (self.wave_errors * 100))
+            self.stdout.write('Waves: %s (%s)\n'
+                              % (', '.join(self.waves), ', '.join(options)))
+
+    def do_until(self, line):
+        """Displays or sets when commands stop waiting for all targets.
+
+        Once the policy is satisfied, outstanding requests are
+        cancelled and the results already received are kept. Supply
+        'off' to always wait for every target.
+
+          > until match 00:1b:2c:3d:4e:5f
+          Commands stop at: match 00:1b:2c:3d:4e:5f
+
+          > until count 50
+          Commands stop at: count 50
+
+          > until quorum 10%
+          Commands stop at: quorum 10%
+
+          > until off
+          Commands wait for all targets.
+        """
+        args = line.split(None, 1)
+        if len(args) == 2:
+            if args[1].strip() == 'off':
+                self.until = None
+            else:
+                try:
+                    self.until = fanout.parse_stop_policy(args[1])
+                except fanout.Error, e:
+                    self.stdout.write('Error: %s\n' % str(e))
+                    return
+        if self.until is None:
+            self.stdout.write('Commands wait for all targets.\n')
+        else:
+            self.stdout.write('Commands stop at: %s\n' % self.until)
+
+    def do_cancel(self, line):
+        """Displays or sets which requests Ctrl-C cancels.
+
+        Pressing Ctrl-C while a command runs cancels its pending
+        requests, keeping the results already received and listing the
+        devices cancelled. Supply 'slower' and a number of seconds to
+        cancel only the requests pending for longer than that, and keep
+        waiting for the rest.
+
+          > cancel slower 30
+          Ctrl-C cancels requests pending for over 30.0 s.
+
+          > cancel all
+          Ctrl-C cancels all pending requests.
+        """
+        args = line.split()
+        if len(args) == 2 and args[1] == 'all':
+            self.cancel_after = None
+        elif len(args) == 3 and args[1] == 'slower':
+            try:
+                self.cancel_after = float(args[2])
+            except ValueError:
+                self.stdout.write(
+                    'Error: The value %r must be float or integer.\n'
+                    % args[2])
+                return
+        elif len(args) > 1:
+            self.stdout.write('Error: Use "cancel all" or '
+                              '"cancel slower <seconds>".\n')
+            return
+        if self.cancel_after is None:
+            self.stdout.write('Ctrl-C cancels all pending requests.\n')
+        else:
+            self.stdout.write('Ctrl-C cancels requests pending for '
+                              'over %.1f s.\n' % self.cancel_after)
+
+    def do_expand(self, line):
+        """Displays the full results of devices in the pager.
+
+        The pager output mode truncates long results. This shows them in
+        full, for the last command sent in that mode.
+
+          > output pager
+          > cmd show run
+          ...
+          > expand ar1.mel,br1.mel
+        """
+        names = self._parse_targets(line)
+        if self.spill is None:
+            self.stdout.write('*** There are no paged results to expand.\n\n')
+            return
+        elif not names:
+            self.stdout.write('*** Supply the devices to expand.\n\n')
+            return
+        unknown = [n for n in names if n not in self.spill]
+        if unknown:
+            self.stdout.write('No results for: %s\n' % ', '.join(unknown))
+        names = [n for n in names if n in self.spill]
+        if not names:
+            return
+        self._open_pager()
+        # Nothing is pending, so Ctrl-C is for the pager alone.
+        self.pager.ignore_interrupts()
+        try:
+            for name in names:
+                for result in self.spill.get(name):
+                    self.stdout.write('%s:\n%s\n' % (name, result))
+        finally:
+            self._stop_paging()
+
     def do_notallowed(self, line):
         """This command is disallowed."""
         # To be used to specifically disable commands from being used.
@@ -239,12 +577,45 @@ class MisterCLI(cmdline.CLI):
           > targets
           Current targets [2]: br1.mel, cr2.syd
 
+        Devices can also be selected by their attributes (as returned
+        by the agents; 'type' is short for 'device_type', and 'site'
+        defaults to the last part of the device name). Separate
+        alternative values with |. Any names or regexps supplied are
+        filtered by the attributes.
+
+          > targets type=juniper|timos site=syd
+          Targets changed to: br1.syd, pe1.syd
+
+          > targets type=cisco_ios ^ar
+          Targets changed to: ar1.mel
+
+        To read a long target list from a file, prefix the file name
+        with @. The file holds device names (or ^regexps), one or more
+        per line. It is checked against the device inventory and any
+        unknown names are listed.
+
+          > targets @/var/tmp/change-1234.txt
+          2 unknown targets: ar9.mel, ^zz.*
+          Targets changed to: ar1.mel, br1.mel, cr2.syd
+
         """
-        targets = self._get_targets(line)
-        if targets is not None:
-            self.targets = targets
-            self.prompt = '%s [t: %d] > ' % (self.PREFIX, len(self.targets))
-            self.stdout.write('Targets changed to: %s\n' % self._targets_str())
+        if len(line.split()) < 2:
+            # Displays the current targets.
+            self._get_targets(line)
+        else:
+            self._change_targets(self._parse_targets(line))
+
+    def _change_targets(self, targets):
+        """Sets the targets from a list of names, ^regexps and @files."""
+        try:
+            targets = self._complete_targets(targets)
+        except AGENT_ERRORS, e:
+            self.stdout.write('*** Cannot validate targets: %s: %s\n\n'
+                              % (e.__class__.__name__, str(e)))
+            return
+        self.targets = targets
+        self.prompt = '%s [t: %d] > ' % (self.PREFIX, len(self.targets))
+        self.stdout.write('Targets changed to: %s\n' % self._targets_str())
 
     def do_timeout(self, line):
         """Displays or sets the timeout, in seconds.
@@ -286,17 +657,51 @@ class MisterCLI(cmdline.CLI):
                     'Error: The value %r must be float or integer.' % args[1])
 
     def _complete_targets(self, targets, only_regexp=False):
+        predicates = [inventory.parse_predicate(t) for t in targets
+                      if inventory.is_predicate(t) and not t.startswith('@')]
+        if predicates:
+            targets = [t for t in targets
+                       if not inventory.is_predicate(t) or t.startswith('@')]
         result = []
+        files = [t[1:] for t in targets if t.startswith('@')]
+        if files:
+            unknown = []
+            # Reads the files in full, extending result.
+            for _ in self._read_target_files(files, result, unknown):
+                pass
+            self._report_unknown(unknown)
         for t in targets:
-            if t.startswith('^') or only_regexp:
+            if t.startswith('@'):
+                continue
+            elif t.startswith('^') or only_regexp:
                 matches = self._devices_matching(t)
                 if matches:
                     result.extend(matches)
             else:
                 if not only_regexp:
                     result.append(t)
+        if predicates:
+            if targets:
+                result = self._select_targets(predicates, result)
+            else:
+                result = self._select_targets(predicates)
         return result
 
+    def _select_targets(self, predicates, names=None):
+        """Returns the devices (of names, if supplied) matching predicates.
+        """
+        inv = self._get_inventory()
+        known = inv.attributes()
+        for attribute, _ in predicates:
+            if attribute not in known:
+                self.stdout.write('No devices have the attribute %r '
+                                  '(known: %s).\n'
+                                  % (attribute, ', '.join(known)))
+        selected = inv.select(predicates)
+        if names is None:
+            return sorted(selected)
+        return [n for n in names if n in selected]
+
     def _parse_targets(self, line):
         """Parses the targets argument."""
         args = line.split()
@@ -310,10 +715,68 @@ class MisterCLI(cmdline.CLI):
                 specs.extend([e for e in spec if e])
             return specs
 
+    def _get_inventory(self):
+        """Returns the Inventory, polling the agents if required."""
+        self._get_device_info(silent=True)
+        if (self.inventory is None or
+            self.inventory.devices is not self._devices):
+            self.inventory = inventory.Inventory(self._devices)
+        return self.inventory
+
+    def _read_target_files(self, paths, targets, unknown):
+        """Reads target files, yielding batches of validated targets.
+
+        Each file is read a line at a time, and targets are validated
+        against the inventory (from a single agent poll) as they are
+        read, so the first batch is available before the file is read
+        in full. Each batch is also appended to targets.
+
+        Args:
+          paths: File names; '-' is standard input.
+          targets: A list, extended with each batch.
+          unknown: A list, extended with specs matching no devices.
+        """
+        inv = self._get_inventory()
+        seen = set(targets)
+        for path in paths:
+            if path == '-':
+                f = self.stdin
+            else:
+                try:
+                    f = open(path)
+                except IOError, e:
+                    self.stdout.write('*** Cannot read targets: %s\n' % e)
+                    continue
+            try:
+                for batch in inventory.resolve_specs(
+                    inventory.read_specs(f), inv, self.TARGET_CHUNK, unknown):
+                    batch = [t for t in batch if t not in seen]
+                    if batch:
+                        seen.update(batch)
+                        targets.extend(batch)
+                        yield batch
+            finally:
+                if f is not self.stdin:
+                    f.close()
+
+    def _report_unknown(self, unknown):
+        """Lists target specs that matched no known devices."""
+        if unknown:
+            self.stdout.write('%d unknown targets: %s\n'
+                              % (len(unknown), ', '.join(unknown)))
+
     def _targets_str(self):
         return str(', '.join(sorted(self.targets)))
 
     def _devices_matching(self, arg, timeout=5.0):
+        if self.replay is not None:
+            try:
+                regexp = re.compile(arg)
+            except re.error, e:
+                self.stdout.write('Invalid regexp %r: %s\n' % (arg, str(e)))
+                return None
+            return [name for name in self.replay.device_names()
+                    if regexp.match(name)]
         try:
             r = notch.client.Request('devices_matching',
                                      arguments={'regexp': arg},
@@ -329,31 +792,272 @@ class MisterCLI(cmdline.CLI):
     def _execute_command(self, command, output_method=None, targets=None):
         """Executes a command (results via an asynchonous callback)."""
         if output_method == 'csv':
-            self._get_device_info(silent=True)
-        targets = targets or self.targets
-        reqs = []
-        for target in targets:
+            self._get_inventory()
+        unknown = []
+        if self.target_files:
+            # Target files are streamed: each batch is sent as it is
+            # validated, and appended to the (initially partial) targets.
+            targets = list(targets or self.targets)
+            batches = self._read_target_files(self.target_files, targets,
+                                              unknown)
+            self.target_files = None
+            if targets:
+                batches = itertools.chain([list(targets)], batches)
+            if (self.waves or self.replay is not None or
+                (self.until is not None and
+                 self.until.kind == fanout.StopPolicy.QUORUM)):
+                # Wave sizes, replay and quorums need the full target
+                # list.
+                for _ in batches:
+                    pass
+                batches = None
+        else:
+            targets = targets or self.targets
+            batches = None
+        self.fanout = fanout.FanOut(command, targets, policy=self.until)
+        if self.recorder is not None:
+            self.fanout.id = self.recorder.new_fanout()
+        if output_method == 'pager':
+            self._start_paging()
+        try:
+            if self.replay is not None:
+                self._replay_command(command, output_method, targets)
+                self.fanout.finished = True
+                self._flush_output_buffers()
+                # Replayed results are recorded like live ones.
+                self._record_fanout()
+            elif batches is not None:
+                self._execute_waves(command, output_method, batches,
+                                    advance=0.0)
+                self._complete_fanout()
+            else:
+                if self.waves:
+                    batches = fanout.split_waves(targets, self.waves)
+                else:
+                    batches = [targets]
+                self._execute_waves(command, output_method, batches)
+                self._complete_fanout()
+            self._report_unknown(unknown)
+        except Exception:
+            # Cancelling also disarms the pending requests' timers, which
+            # would otherwise go off during later commands.
+            self._cancel_requests()
+            self.fanout.finished = True
+            self._stop_paging()
+            raise
+        # If interrupted, paging stops once cancellation is reported.
+        self._stop_paging()
+
+    def _start_paging(self):
+        """Sends output to a new pager, keeping full results in a spill."""
+        if self.spill is not None:
+            self.spill.close()
+        self.spill = pager.Spill()
+        self.invalidate_completions()
+        self._open_pager()
+
+    def _open_pager(self):
+        self.pager = pager.Pager()
+        self._unpaged_stdout = self.stdout
+        self.stdout = self.pager
+
+    def _stop_paging(self):
+        """Restores output to the terminal once the pager exits."""
+        if self.pager is None:
+            return
+        p = self.pager
+        self.pager = None
+        self.stdout = self._unpaged_stdout
+        self._unpaged_stdout = None
+        p.close()
+
+    def _execute_waves(self, command, output_method, batches,
+                       advance=None):
+        """Sends each batch of targets as a wave.
+
+        A wave is sent once 'advance' (by default, WAVE_ADVANCE) of the
+        previous wave has completed, so stragglers from one wave overlap
+        the next. If the previous wave's error rate exceeds wave_errors,
+        or the fan-out's stop policy is satisfied, no further requests
+        are sent.
+        """
+        if advance is None:
+            advance = self.WAVE_ADVANCE
+        previous = None
+        halted = False
+        for batch in batches:
+            if previous is not None and not halted:
+                self._wait_wave(previous, advance)
+                if (self.wave_errors is not None and
+                    previous.error_rate() > self.wave_errors):
+                    self.stdout.write(
+                        'Wave %d error rate %.0f%% exceeds %.0f%%; '
+                        'not sending further waves.\n'
+                        % (previous.index, previous.error_rate() * 100,
+                           self.wave_errors * 100))
+                    halted = True
+            if halted or self.fanout.stopped:
+                halted = True
+                continue
+            wave = self.fanout.add_wave(batch,
+                                        self.wave_timeout or self.timeout)
+            self._send_wave(wave, command, output_method)
+            previous = wave
+            self._report_waves()
+
+    def _complete_fanout(self):
+        """Waits for the current fan-out's outstanding requests and reports.
+        """
+        fo = self.fanout
+        for wave in fo.waves:
+            self._wait_wave(wave)
+        fo.finished = True
+        self._report_waves(all_waves=True)
+        self._flush_output_buffers()
+        if fo.stopped:
+            self._report('Stopped after %d responses (until %s); '
+                         'cancelled %d requests.'
+                         % (fo.done, fo.policy, fo.cancelled))
+        unsent = len(fo.targets) - fo.sent()
+        if unsent:
+            self._report('%d targets were not sent the command.' % unsent)
+        self._record_fanout()
+
+    def _send_wave(self, wave, command, output_method):
+        """Sends a wave's requests.
+
+        Requests are sent one at a time, as the client blocks once its
+        concurrency limit is reached. This lets sending stop promptly
+        once the stop policy is satisfied, and keeps each request paired
+        with its green thread should it need to be cancelled.
+        """
+        logging.debug('Executing %d requests (wave %d).',
+                      len(wave.targets), wave.index)
+        for target in wave.targets:
+            if self.fanout.stopped:
+                return
             method_args = {'device_name': target,
                            'command': command}
-            kwargs = {'output_method': output_method}
+            kwargs = {'output_method': output_method,
+                      'fanout': self.fanout,
+                      'wave': wave.index}
             r = notch.client.Request('command',
                                      arguments=method_args,
                                      callback=self._notch_callback,
                                      callback_kwargs=kwargs,
-                                     timeout_s=self.timeout)
-            reqs.append(r)
-        logging.debug('Executing %d requests.', len(reqs))
-        gts = self.notch.exec_requests(reqs)
-        if gts:
+                                     timeout_s=wave.timeout)
+            gt = None
+            while gt is None:
+                try:
+                    gt = self.notch.exec_request(r)
+                except notch.client.TimeoutError:
+                    # An earlier request timed out while the client's pool
+                    # was full; this one wasn't sent.
+                    self._expire_wave()
+                    if wave.expired:
+                        return
+            # Set once sent, as the client blocks while its pool is full.
+            r.time_sent = time.time()
+            wave.requests.append(r)
+            wave.gts.append(gt)
+            if self.fanout.stopped:
+                # The stop policy was satisfied while the client's pool
+                # was full; this request hasn't started, so cancel it.
+                self._cancel_requests()
+                return
+
+    def _wait_wave(self, wave, fraction=1.0):
+        """Waits until at least 'fraction' of a wave's requests are done.
+
+        Completions are counted by the callbacks (and cancellations by
+        _cancel_requests), in whatever order they happen, so a slow
+        request early in the wave doesn't hold up the rest.
+        """
+        wanted = int(math.ceil(len(wave.gts) * fraction))
+        reaped = time.time()
+        while wave.settled() < wanted and not wave.expired:
             try:
-                for gt in gts:
-                    logging.debug('Waiting for %r', gt)
-                    gt.wait()
+                self._progress.get(timeout=self.REAP_INTERVAL)
+            except eventlet.queue.Empty:
+                pass
             except notch.client.TimeoutError:
-                self.stdout.write('Request timed out (%.1f s).\n' %
-                                  self.timeout)
+                self._expire_wave()
+            if time.time() - reaped >= self.REAP_INTERVAL:
+                self._reap_failures(wave)
+                reaped = time.time()
+
+    def _expire_wave(self):
+        """Handles a request timeout, raised in the main green thread.
+
+        The requests in a fan-out share a timeout, and the client starts
+        each request's timer as it is sent, so the timeout is the oldest
+        pending request's. Its wave has expired, as has any other wave
+        with a request pending for longer than the timeout. Their
+        pending requests are cancelled; this also disarms their timers.
+        """
+        pending = self.fanout.pending()
+        if not pending:
+            return
+        now = time.time()
+        expired = [pending[0][0]]
+        for wave, request, _ in pending:
+            if (wave not in expired and request.time_sent is not None and
+                now - request.time_sent >= wave.timeout):
+                expired.append(wave)
+        for wave in expired:
+            wave.expired = True
+        cancelled = self._cancel_requests(in_waves=expired)
+        self.stdout.write('%d requests timed out (%.1f s).\n'
+                          % (len(cancelled), expired[0].timeout))
+
+    def _reap_failures(self, wave):
+        """Reports requests whose green thread failed without a callback.
+
+        The green thread raised, so the client's link (which waits on it
+        too) raised before running the callback; the failure is reported
+        as the request's error. The client sets result or error before
+        it runs the callback, so a request with neither has not been
+        through _notch_callback and won't be called back twice.
+        """
+        for request, gt in zip(wave.requests, wave.gts):
+            if (gt.dead and request.result is None
+                and request.error is None):
+                try:
+                    gt.wait()
+                except CLIENT_FAILURES, e:
+                    request.error = e
+                    self._notch_callback(request, *request.callback_args,
+                                         **request.callback_kwargs)
+
+    def _report_waves(self, all_waves=False):
+        """Summarises finished waves (or all waves) not yet reported."""
+        if not self.waves:
+            # Batches streamed from target files are not waves.
+            return
+        for wave in self.fanout.waves:
+            if wave.reported or not (all_waves or wave.finished()):
+                continue
+            wave.reported = True
+            self._report('Wave %d complete: %d ok, %d errors (of %d targets).'
+                         % (wave.index, wave.done - wave.errors, wave.errors,
+                            len(wave)))
+
+    def _report(self, message):
+        """Displays a progress message, unless output is being parsed."""
+        if self.from_cmd_loop:
+            self.stdout.write(message + '\n')
         else:
-            self.notch.wait_all()
+            logging.info(message)
+
+    def _replay_command(self, command, output_method, targets):
+        """Serves a command's results from the replay archive."""
+        for target in targets:
+            if self.fanout.stopped:
+                break
+            record = self.replay.lookup(target, command)
+            request = _ReplayedRequest(target, command, record)
+            self._notch_callback(request, output_method=output_method,
+                                 fanout=self.fanout)
 
     def _print_error(self, request):
         device_name = request.arguments.get('device_name', 'from agent')
@@ -367,17 +1071,114 @@ class MisterCLI(cmdline.CLI):
     def _notch_callback(self, request, *args, **kwargs):
         _ = args
         output_method = kwargs.get('output_method')
+        fo = kwargs.get('fanout') or self.fanout
         request.finish()
+        if fo.stopped or fo.finished or fo.is_cancelled(request):
+            # A late response, after the stop policy was satisfied or the
+            # fan-out was cancelled or timed out, or the client calling
+            # back for a request we cancelled.
+            return
+        stop = fo.completed(request, kwargs.get('wave'))
+        if self._progress.getting():
+            # Wake _wait_wave.
+            self._progress.put(request)
+        if self.recorder is not None:
+            self._record_result(request)
         if output_method is not None and hasattr(
             self, '_output_' + output_method):
             method = getattr(self, '_output_' + output_method)
         else:
             method = self._output_text
         method(request)
+        if stop:
+            self._cancel_requests()
+
+    def _cancel_requests(self, older_than=None, in_waves=None):
+        """Cancels the current fan-out's outstanding requests.
+
+        Killing a green thread switches to it and on to others, which
+        may cancel requests too (e.g., the stop policy's callback and
+        _send_wave), or be interrupted by a request's timer. So the
+        requests are all recorded as cancelled, and their timers
+        disarmed, before any is killed.
+
+        Args:
+          older_than: None, or only cancel requests sent at least this
+            many seconds ago.
+          in_waves: None, or only cancel requests in these Waves.
+
+        Returns:
+          A list of the cancelled requests.
+        """
+        now = time.time()
+        cancelled = []
+        for wave, request, gt in self.fanout.pending():
+            if in_waves is not None and wave not in in_waves:
+                continue
+            if (older_than is not None and request.time_sent is not None
+                and now - request.time_sent < older_than):
+                continue
+            self.fanout.cancel(wave, request)
+            request.error = notch.client.RequestCancelledError(
+                'Cancelled by user')
+            # Also cancels the request's timeout.
+            request.finish()
+            cancelled.append((request, gt))
+        if [gt for _, gt in cancelled if not (gt or gt.dead)]:
+            # Killing a green thread that hasn't started raises in the
+            # hub, so let them start first.
+            eventlet.sleep(0)
+        for _, gt in cancelled:
+            gt.kill(notch.client.RequestCancelledError)
+        return [request for request, _ in cancelled]
+
+    def _record_result(self, request):
+        try:
+            self.recorder.record_result(
+                self.fanout.id, request.arguments.get('device_name'),
+                request.arguments.get('command'), result=request.result,
+                error=request.error, elapsed=self.fanout.elapsed())
+        except (archive.Error, IOError, ValueError), e:
+            logging.error('Could not record result: %s', e)
+
+    def _record_fanout(self):
+        if self.recorder is None:
+            return
+        fo = self.fanout
+        try:
+            self.recorder.record_fanout(fo.id, fo.command, fo.targets,
+                                        fo.started, fo.elapsed())
+        except (archive.Error, IOError, ValueError), e:
+            logging.error('Could not record fan-out: %s', e)
+
+    def _device_names(self):
+        """Returns the names of all known devices and the values of
+        COMPLETED_ATTRIBUTES (e.g., 'type=juniper'), for completion.
+        """
+        try:
+            inv = self._get_inventory()
+        except AGENT_ERRORS:
+            return []
+        words = list(inv.names())
+        for attribute in self.COMPLETED_ATTRIBUTES:
+            words.extend('%s=%s' % (attribute, value)
+                         for value in inv.index(attribute))
+        return words
 
     def _get_device_info(self, silent=False, reload=False):
         if (not self._devices) or reload:
-            self._devices = self.notch.devices_info(r'^.*$')
+            if self.replay is not None:
+                self._devices = self.replay.devices()
+                if not self._devices:
+                    # The archive has no inventory; use its result
+                    # devices, so that it is only read once.
+                    self._devices = dict(
+                        (n, {}) for n in self.replay.device_names())
+            else:
+                self._devices = self.notch.devices_info(r'^.*$')
+                if self.recorder is not None:
+                    self.recorder.record_devices(self._devices)
+            self.invalidate_completions()
             if not silent:
                 self.stdout.write('Agent polled for %d devices\n'
                                   % len(self._devices))
@@ -386,11 +1187,9 @@ class MisterCLI(cmdline.CLI):
         device_name = request.arguments.get('device_name')
         command = request.arguments.get('command')
 
-        device = self._devices.get(device_name)
-        if device:
-            device_type = device.get('device_type')
-        else:
-            device_type = 'UNKNOWN_DEVICE'
+        # The inventory is loaded by _execute_command.
+        device_type = self.inventory.get(device_name, 'device_type',
+                                         'UNKNOWN_DEVICE')
 
         if command is None:
             logging.warn('Not a command request. Not sure how to proceed.')
@@ -422,6 +1221,14 @@ class MisterCLI(cmdline.CLI):
         else:
             self._print_error(request)
 
+    def _flush_output_buffers(self):
+        """Writes and discards results held by buffering output modes."""
+        buffers = self.output_buffers
+        self.output_buffers = {}
+        for device_name in sorted(buffers):
+            for result in buffers[device_name]:
+                self.stdout.write('%s:\n%s\n' % (device_name, result))
+
     def _output_buffered_text(self, request):
         device_name = request.arguments.get('device_name')
         if request.result is not None:
@@ -435,6 +1242,32 @@ class MisterCLI(cmdline.CLI):
             self.stdout.write('%s: Incomplete response from Notch Agent.\n' %
                               device_name)
 
+    def _output_pager(self, request):
+        device_name = request.arguments.get('device_name')
+        if request.result is not None:
+            self.spill.add(device_name, request.result)
+            head, omitted = pager.truncate(request.result, self.PAGER_LINES)
+            self.stdout.write('%s:\n%s' % (device_name, head))
+            if omitted:
+                if not head.endswith('\n'):
+                    self.stdout.write('\n')
+                self.stdout.write('... %d more lines (expand %s)\n'
+                                  % (omitted, device_name))
+            self.stdout.write('\n')
+            # The full result is in the spill; don't hold it in memory.
+            request.result = None
+        elif request.error is not None:
+            self._print_error(request)
+        else:
+            self.stdout.write('%s: Incomplete response from Notch Agent.\n' %
+                              device_name)
+
+    def _spilled_device_names(self):
+        """Returns the devices with results to expand, for completion."""
+        if self.spill is None:
+            return []
+        return self.spill.device_names()
+
     def _output_text(self, request):
         device_name = request.arguments.get('device_name')
         if request.result is not None:
@@ -447,6 +1280,12 @@ class MisterCLI(cmdline.CLI):
                               device_name)
 
     def interrupted(self):
+        if self.notch is None:
+            self._stop_paging()
+            return True
+        if self.fanout is not None and not self.fanout.finished:
+            self._cancel_stragglers()
+            return
         if self.notch.num_requests_running or self.notch.num_requests_waiting:
             self.stdout.write('\nCancelling all requests.\n')
             self.notch.kill_all()
@@ -455,6 +1294,58 @@ class MisterCLI(cmdline.CLI):
             # No requests underway, so return True to stop the command-loop.
             return True
 
+    def _cancel_stragglers(self):
+        """Cancels the interrupted fan-out's pending requests.
+
+        If cancel_after is set, only requests outstanding for longer than
+        that are cancelled and the rest are waited upon; interrupting
+        again cancels those too. Results received are kept.
+        """
+        cancelled = self._cancel_requests(older_than=self.cancel_after)
+        if self.cancel_after is None:
+            self.stdout.write('\nCancelling %d pending requests.\n'
+                              % len(cancelled))
+        else:
+            self.stdout.write(
+                '\nCancelling %d requests pending for over %.1f s; '
+                'waiting for %d (Ctrl-C again to cancel all).\n'
+                % (len(cancelled), self.cancel_after,
+                   len(self.fanout.pending())))
+        try:
+            self._complete_fanout()
+        except KeyboardInterrupt:
+            cancelled.extend(self._cancel_requests())
+            self._complete_fanout()
+        if cancelled:
+            names = sorted(r.arguments.get('device_name') for r in cancelled)
+            self.stdout.write('Cancelled devices (%d): %s\n'
+                              % (len(names), ', '.join(names)))
+        self._stop_paging()
+
+
+class _ReplayedRequest(object):
+    """Stands in for a notch.client.Request whose response was archived."""
+
+    def __init__(self, device_name, command, record):
+        self.arguments = {'device_name': device_name, 'command': command}
+        self.result = None
+        self.error = None
+        if record is None:
+            self.error = archive.error_class('NotRecordedError')(
+                'No recorded result for %r' % command)
+        elif record['error'] is not None:
+            name, message = record['error']
+            error_class = getattr(notch.client, name, None)
+            if not (isinstance(error_class, type)
+                    and issubclass(error_class, Exception)):
+                error_class = archive.error_class(name)
+            self.error = error_class(message)
+        else:
+            self.result = record['result']
+
+    def finish(self):
+        pass
+
 
 def get_option_parser():
     prog = os.path.basename(sys.argv[0])
@@ -478,6 +1369,10 @@ def get_option_parser():
     parser.add_option('-t', '--target', dest='targets', action='append',
                       default=None,
                       help='Adds a single target device')
+    parser.add_option('-T', '--targets-file', dest='target_files',
+                      action='append', default=None, metavar='FILE',
+                      help='Adds the target devices listed in FILE '
+                      '(- for stdin)')
     parser.add_option('-c', '--cmd', dest='cmd', default=None,
                       help='The command to execute on each target')
     modes = ['text']
@@ -486,6 +1381,20 @@ def get_option_parser():
     parser.add_option('-o', '--output', dest='mode', default=None,
                       help='Use output mode (%s)'
                       % ', '.join(modes))
+    parser.add_option('-r', '--record', dest='record', default=None,
+                      metavar='FILE',
+                      help='Append all results to the archive FILE')
+    parser.add_option('--offline', dest='offline', default=None,
+                      metavar='FILE',
+                      help='Replay results from the archive FILE instead '
+                      'of contacting agents')
+    parser.add_option('-w', '--waves', dest='waves', default=None,
+                      metavar='SPEC',
+                      help='Send the command in waves, e.g., "1%,10%,rest"')
+    parser.add_option('-u', '--until', dest='until', default=None,
+                      metavar='POLICY',
+                      help='Stop once the policy is satisfied, e.g., '
+                      '"match REGEXP", "count 50" or "quorum 10%"')
     return parser
 
 
@@ -511,18 +1420,39 @@ def main():
     option_parser = get_option_parser()
     options, args = option_parser.parse_args()
 
+    if '-' in (options.target_files or ()) and not options.cmd:
+        option_parser.error('-T - (targets from stdin) requires -c')
+
     agents = _get_agents(args)
     # Start the Notch client and CLI
     try:
-        nc = notch.client.Connection(agents)
-        cli = MisterCLI(nc, targets=options.targets)
+        recorder = replay = None
+        if options.record:
+            recorder = archive.Archive(options.record, writable=True)
+        if options.offline:
+            replay = archive.Archive(options.offline)
+            nc = None
+        else:
+            nc = notch.client.Connection(agents)
+        cli = MisterCLI(nc, targets=options.targets, recorder=recorder,
+                        replay=replay)
+
+        if options.waves:
+            cli.waves = fanout.parse_wave_spec(options.waves)
+        if options.until:
+            cli.until = fanout.parse_stop_policy(options.until)
 
         if options.cmd:
             cli.from_cmd_loop = False
+            cli.target_files = options.target_files
             if options.mode != 'text':
                 cli.do_output('output %s' % options.mode)
             cli.do_command('cmd %s' % options.cmd)
         else:
+            if options.target_files:
+                # Passed as a list, as file names may contain spaces.
+                cli._change_targets(
+                    cli.targets + ['@' + f for f in options.target_files])
             print WELCOME_MSG
             cli.cmdloop()
             print '\nBye.'
@@ -531,6 +1461,9 @@ def main():
         print
         print option_parser.get_usage()
         raise SystemExit(1)
+    except (archive.Error, fanout.Error), e:
+        print str(e)
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the mrcli module."""
+
+import StringIO
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import eventlet
+import notch.client
+
+import archive
+import fanout
+import mrcli
+
+
+def run_request(request, delay):
+    """Runs a request as the Notch client would, completing it after delay.
+
+    Returns:
+      The request's green thread.
+    """
+    def run():
+        # Like the Notch client, which calls back even when killed.
+        try:
+            eventlet.sleep(delay)
+            request.result = '%s ok' % request.arguments['device_name']
+        except Exception, e:
+            request.error = e
+        request.callback(request, *request.callback_args,
+                         **request.callback_kwargs)
+        return request
+
+    gt = eventlet.spawn(run)
+    request.start()
+    request.time_sent = time.time()
+    return gt
+
+
+def fake_request(cli, device_name, delay, wave=1, timeout=None):
+    """Returns a request and a green thread completing it after delay."""
+    request = notch.client.Request(
+        'command', arguments={'device_name': device_name,
+                              'command': 'show ver'},
+        callback=cli._notch_callback,
+        callback_kwargs={'fanout': cli.fanout, 'wave': wave},
+        timeout_s=timeout)
+    return request, run_request(request, delay)
+
+
+class WaitWaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cli = mrcli.MisterCLI(None, stdout=StringIO.StringIO())
+        self.cli.fanout = fanout.FanOut('show ver', [])
+        self.wave = self.cli.fanout.add_wave([], 10.0)
+
+    def add(self, device_name, delay):
+        request, gt = fake_request(self.cli, device_name, delay)
+        self.wave.targets.append(device_name)
+        self.wave.requests.append(request)
+        self.wave.gts.append(gt)
+
+    def testStragglerDoesNotHoldUpAdvance(self):
+        # The first request sent is the slowest.
+        self.add('d0', 2.0)
+        for i in range(1, 10):
+            self.add('d%d' % i, 0.01)
+        start = time.time()
+        self.cli._wait_wave(self.wave, 0.9)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(9, self.wave.done)
+        self.cli._cancel_requests()
+        self.cli._wait_wave(self.wave)
+        self.assertEqual(1, self.wave.cancelled)
+
+    def testWaitsForAll(self):
+        for i in range(5):
+            self.add('d%d' % i, 0.01 * (5 - i))
+        self.cli._wait_wave(self.wave)
+        self.assertEqual(5, self.wave.done)
+
+
+class CancelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out = StringIO.StringIO()
+        self.cli = mrcli.MisterCLI(None, stdout=self.out)
+        self.cli.fanout = fanout.FanOut('show ver', [])
+        self.wave = self.cli.fanout.add_wave([], 10.0)
+
+    def add(self, device_name, delay):
+        request, gt = fake_request(self.cli, device_name, delay)
+        self.wave.targets.append(device_name)
+        self.wave.requests.append(request)
+        self.wave.gts.append(gt)
+
+    def testCancelAll(self):
+        for i in range(3):
+            self.add('d%d' % i, 5.0)
+        eventlet.sleep(0)
+        self.cli._cancel_stragglers()
+        fo = self.cli.fanout
+        self.assertTrue(fo.finished)
+        self.assertEqual((0, 0, 3), (fo.done, fo.errors, fo.cancelled))
+        self.assertEqual(3, self.wave.cancelled)
+        self.assertTrue('Cancelled devices (3): d0, d1, d2' in
+                        self.out.getvalue())
+
+    def testCancelSlowerWaitsForTheRest(self):
+        self.cli.cancel_after = 0.2
+        self.add('d0', 5.0)
+        self.add('d1', 5.0)
+        eventlet.sleep(0.3)
+        self.add('d2', 0.1)
+        self.add('d3', 0.2)
+        start = time.time()
+        self.cli._cancel_stragglers()
+        self.assertTrue(time.time() - start >= 0.15)
+        fo = self.cli.fanout
+        self.assertEqual((2, 0, 2), (fo.done, fo.errors, fo.cancelled))
+        self.assertEqual(4, self.wave.settled())
+        out = self.out.getvalue()
+        self.assertTrue('waiting for 2' in out)
+        self.assertTrue('d2:\nd2 ok' in out and 'd3:\nd3 ok' in out)
+        self.assertTrue('Cancelled devices (2): d0, d1' in out)
+
+
+    def testReentrantCancel(self):
+        for i in range(4):
+            self.add('d%d' % i, 5.0)
+        eventlet.sleep(0)
+        # Another green thread cancels while the first kill switches.
+        gt = self.wave.gts[0]
+        self.wave.gts[0] = ReentrantKill(gt, self.cli._cancel_requests)
+        self.assertEqual(4, len(self.cli._cancel_requests()))
+        self.assertEqual([], self.wave.gts[0].cancelled)
+        self.assertEqual((4, 4), (self.cli.fanout.cancelled,
+                                  self.wave.cancelled))
+        self.assertEqual([], self.cli._cancel_requests())
+
+    def testStopPolicy(self):
+        self.cli.fanout.policy = fanout.parse_stop_policy('count 2')
+        for i in range(10):
+            self.add('d%d' % i, i < 2 and 0.01 or 5.0)
+        self.cli._complete_fanout()
+        fo = self.cli.fanout
+        self.assertTrue(fo.stopped)
+        self.assertEqual((2, 8), (fo.done, fo.cancelled))
+        self.assertEqual(10, self.wave.settled())
+        self.assertTrue('Stopped after 2 responses (until count 2); '
+                        'cancelled 8 requests.' in self.out.getvalue())
+
+
+class ReentrantKill(object):
+    """A green thread whose kill first runs another cancellation."""
+
+    def __init__(self, gt, cancel):
+        self.gt = gt
+        self.cancel = cancel
+
+    def kill(self, *args):
+        cancel, self.cancel = self.cancel, None
+        if cancel is not None:
+            self.cancelled = cancel()
+        self.gt.kill(*args)
+
+
+class TimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out = StringIO.StringIO()
+        self.cli = mrcli.MisterCLI(None, stdout=self.out)
+        self.cli.fanout = fanout.FanOut('show ver', [])
+
+    def add_wave(self, delays, timeout):
+        wave = self.cli.fanout.add_wave([], timeout)
+        for i, delay in enumerate(delays):
+            name = 'w%dd%d' % (wave.index, i)
+            request, gt = fake_request(self.cli, name, delay, wave.index,
+                                       timeout)
+            wave.targets.append(name)
+            wave.requests.append(request)
+            wave.gts.append(gt)
+        return wave
+
+    def testWaveExpires(self):
+        wave = self.add_wave([0.01, 5.0, 5.0], 0.2)
+        self.cli._wait_wave(wave)
+        self.assertTrue(wave.expired)
+        self.assertEqual((1, 2), (wave.done, wave.cancelled))
+        self.assertTrue('2 requests timed out (0.2 s).' in
+                        self.out.getvalue())
+        # The cancelled requests' timers were disarmed.
+        eventlet.sleep(0.3)
+
+    def testTimeoutOfAnotherWave(self):
+        first = self.add_wave([5.0], 0.1)
+        second = self.add_wave([0.3, 0.3], 1.0)
+        self.cli._wait_wave(second)
+        self.assertTrue(first.expired)
+        self.assertEqual(1, first.cancelled)
+        self.assertFalse(second.expired)
+        self.assertEqual(2, second.done)
+
+    def testTimeoutWhileSending(self):
+        self.cli.notch = FakeClient(delay=5.0, block=0.15)
+        wave = self.cli.fanout.add_wave(['d0', 'd1', 'd2', 'd3'], 0.2)
+        self.cli._send_wave(wave, 'show ver', None)
+        self.assertTrue(wave.expired)
+        self.assertEqual((2, 2), (self.cli.fanout.sent(), wave.cancelled))
+        self.cli._complete_fanout()
+        self.assertTrue(self.cli.fanout.finished)
+        self.assertTrue('2 targets were not sent the command.' in
+                        self.out.getvalue())
+        eventlet.sleep(0.3)
+
+
+class FakeClient(object):
+    """Runs requests after waiting 'block' seconds, as if for a free slot
+    in the Notch client's pool.
+    """
+
+    def __init__(self, delay, block=0.0):
+        self.delay = delay
+        self.block = block
+
+    def exec_request(self, request):
+        eventlet.sleep(self.block)
+        return run_request(request, self.delay)
+
+
+class FakeNotch(object):
+
+    def __init__(self, names):
+        self.names = names
+
+    def devices_info(self, regexp):
+        return dict((n, {'device_name': n}) for n in self.names)
+
+
+class TargetFileTest(unittest.TestCase):
+
+    def setUp(self):
+        names = ['d%03d' % i for i in range(100)]
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, '\n'.join(names) + '\n')
+        os.close(fd)
+        self.cli = mrcli.MisterCLI(FakeNotch(names),
+                                   stdout=StringIO.StringIO())
+        self.cli.TARGET_CHUNK = 10
+        self.cli.from_cmd_loop = False
+        self.cli.target_files = [self.path]
+        self.sent = []
+        self.cli._execute_waves = self.execute_waves
+        self.cli._complete_fanout = lambda: None
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def execute_waves(self, command, output_method, batches, advance=None):
+        for batch in batches:
+            # The number of targets known when each batch is sent.
+            self.sent.append((len(batch), len(self.cli.fanout.targets)))
+
+    def testStreamsBatches(self):
+        self.cli.do_command('cmd show ver')
+        self.assertEqual([(10, 10)] + [(10, t) for t in range(20, 101, 10)],
+                         self.sent)
+
+    def testQuorumReadsAllTargetsFirst(self):
+        self.cli.until = fanout.parse_stop_policy('quorum 50%')
+        self.cli.do_command('cmd show ver')
+        self.assertEqual([(100, 100)], self.sent)
+
+    def testBatchesAreNotWaves(self):
+        self.cli.from_cmd_loop = True
+        self.cli.fanout = fanout.FanOut('show ver', ['d000', 'd001'])
+        for name in self.cli.fanout.targets:
+            # Each streamed batch is sent as a wave of the fan-out.
+            self.cli.fanout.add_wave([name], 10.0).done = 1
+        self.cli._report_waves()
+        self.assertEqual('', self.cli.stdout.getvalue())
+
+    def testFileNameWithSpaces(self):
+        fd, path = tempfile.mkstemp(prefix='change 1234 ')
+        os.write(fd, 'd001\nd002\n')
+        os.close(fd)
+        try:
+            self.cli._change_targets(['d000', '@' + path])
+        finally:
+            os.unlink(path)
+        self.assertEqual(['d000', 'd001', 'd002'], sorted(self.cli.targets))
+
+
+class FailingNotch(object):
+
+    def devices_info(self, regexp):
+        raise notch.client.errors.ApiError('agent down')
+
+
+class AgentErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, 'd001\n')
+        os.close(fd)
+        self.out = StringIO.StringIO()
+        self.cli = mrcli.MisterCLI(FailingNotch(), stdout=self.out)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testTargetFile(self):
+        self.cli.do_targets('targets @%s' % self.path)
+        self.assertEqual([], self.cli.targets)
+        self.assertTrue('ApiError: agent down' in self.out.getvalue())
+
+    def testCompletion(self):
+        self.assertEqual([], self.cli.completions('targets d', 'd'))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        replay_path = os.path.join(self.dir, 'replay.mra')
+        a = archive.Archive(replay_path, writable=True)
+        a.record_result(a.new_fanout(), 'd001', 'show ver', 'JUNOS 10.0\n')
+        a.close()
+        self.record_path = os.path.join(self.dir, 'record.mra')
+        self.cli = mrcli.MisterCLI(
+            None, stdout=StringIO.StringIO(),
+            recorder=archive.Archive(self.record_path, writable=True),
+            replay=archive.Archive(replay_path))
+        self.cli.targets = ['d001', 'd002']
+
+    def tearDown(self):
+        self.cli.replay.close()
+        shutil.rmtree(self.dir)
+
+    def testRecordsReplayedFanOut(self):
+        self.cli.do_command('cmd show ver')
+        self.cli.recorder.close()
+        recorded = archive.Archive(self.record_path)
+        try:
+            self.assertEqual([('show ver', ['d001', 'd002'])],
+                             [(f['command'], f['targets'])
+                              for f in recorded.fanouts()])
+            self.assertEqual('JUNOS 10.0\n',
+                             recorded.lookup('d001', 'show ver')['result'])
+            self.assertEqual(('NotRecordedError',),
+                             recorded.lookup('d002', 'show ver')['error'][:1])
+        finally:
+            recorded.close()
+
+    def testInventoryFromResultsIsCached(self):
+        inv = self.cli._get_inventory()
+        self.assertEqual(['d001'], sorted(inv.devices))
+        self.cli.replay.device_names = None
+        self.assertTrue(self.cli._get_inventory() is inv)
+
+
+if __name__ == '__main__':
+    unittest.main()
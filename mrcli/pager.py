@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Paged display of large fan-out results.
+
+A Pager feeds text to a pager process (such as less) through a pipe. A
+Spill keeps full results on disk, so that results shown truncated can be
+displayed in full later without being held in memory.
+"""
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import subprocess
+import tempfile
+
+
+DEFAULT_PAGER = 'less'
+# Options for less (if $LESS is unset): quit if the text fits on one
+# screen, pass colours through and don't clear the screen on exit.
+DEFAULT_LESS = 'FRX'
+
+# Bytes read from the queue per write to the pipe.
+_CHUNK = 65536
+
+
+def truncate(text, max_lines):
+    """Truncates text after max_lines lines.
+
+    Returns:
+      A tuple (head, omitted), where omitted is the number of lines
+      removed from text (zero if text was not truncated).
+    """
+    pos = -1
+    for _ in xrange(max_lines):
+        pos = text.find('\n', pos + 1)
+        if pos == -1 or pos == len(text) - 1:
+            return text, 0
+    omitted = text.count('\n', pos + 1)
+    if not text.endswith('\n'):
+        omitted += 1
+    return text[:pos + 1], omitted
+
+
+class Spill(object):
+    """Results stored in a temporary file, indexed by device name."""
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        # device_name -> [(offset, length), ...]
+        self._index = {}
+
+    def __contains__(self, device_name):
+        return device_name in self._index
+
+    def device_names(self):
+        return sorted(self._index)
+
+    def add(self, device_name, result):
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(result)
+        self._index.setdefault(device_name, []).append(
+            (offset, len(result)))
+
+    def get(self, device_name):
+        """Yields each result stored for a device."""
+        for offset, length in self._index.get(device_name, ()):
+            self._file.seek(offset)
+            yield self._file.read(length)
+
+    def close(self):
+        self._file.close()
+
+
+class Pager(object):
+    """A pager process, written to like a file.
+
+    The pipe to the pager is non-blocking. Text the pager has not yet
+    accepted (because the reader has not scrolled that far) is queued in
+    a temporary file, so writing never stalls the caller and the queue
+    is not held in memory.
+
+    The pager owns the terminal, so Ctrl-C reaches both it and the
+    caller. Once the caller is only waiting on the pager (in close(), or
+    after ignore_interrupts()), SIGINT is ignored until the pager exits or
+    is closed, so that Ctrl-C in the pager doesn't interrupt the caller
+    too. Pagers must be used from the main thread.
+
+    Attributes:
+      process: The pager's subprocess.Popen object.
+      closed: True once the pager has exited or been closed.
+    """
+
+    def __init__(self, command=None):
+        command = command or os.environ.get('PAGER') or DEFAULT_PAGER
+        env = dict(os.environ)
+        env.setdefault('LESS', DEFAULT_LESS)
+        self.process = subprocess.Popen(command, shell=True, env=env,
+                                        stdin=subprocess.PIPE)
+        self._fd = self.process.stdin.fileno()
+        flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._queue = tempfile.TemporaryFile()
+        self._queued = 0
+        self._sent = 0
+        self._pending = ''
+        self._sigint = None
+        self._ignoring_sigint = False
+        self.closed = False
+
+    def ignore_interrupts(self):
+        """Ignores SIGINT until the pager exits or is closed."""
+        if not (self.closed or self._ignoring_sigint):
+            self._sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._ignoring_sigint = True
+
+    def _release_sigint(self):
+        """Restores the caller's SIGINT handler."""
+        if self._ignoring_sigint:
+            self._ignoring_sigint = False
+            # The old handler is None if it was not set from Python.
+            signal.signal(signal.SIGINT, self._sigint or signal.SIG_DFL)
+
+    def write(self, data):
+        if not self.closed and self.process.poll() is not None:
+            # The reader quit the pager.
+            self.closed = True
+            self._release_sigint()
+        if self.closed:
+            return
+        self._queue.seek(self._queued)
+        self._queue.write(data)
+        self._queued += len(data)
+        self._pump()
+
+    def flush(self):
+        self._pump()
+
+    def _pump(self, block=False):
+        """Writes queued text to the pager until the pipe is full.
+
+        Args:
+          block: If True, wait for the pager until the queue is empty.
+        """
+        while not self.closed:
+            if not self._pending:
+                if self._sent == self._queued:
+                    return
+                self._queue.seek(self._sent)
+                self._pending = self._queue.read(
+                    min(_CHUNK, self._queued - self._sent))
+                self._sent += len(self._pending)
+            try:
+                written = os.write(self._fd, self._pending)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    if not block:
+                        return
+                    select.select([], [self._fd], [])
+                    continue
+                elif e.errno == errno.EPIPE:
+                    # The reader quit the pager.
+                    self.closed = True
+                    self._release_sigint()
+                    return
+                raise
+            self._pending = self._pending[written:]
+
+    def close(self):
+        """Sends the remaining text, then waits for the pager to exit."""
+        self.ignore_interrupts()
+        try:
+            self._pump(block=True)
+        finally:
+            self.closed = True
+            self._queue.close()
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            self.process.wait()
+            self._release_sigint()
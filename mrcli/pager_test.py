@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the pager module."""
+
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+import pager
+
+
+class TruncateTest(unittest.TestCase):
+
+    def testShortText(self):
+        self.assertEqual(('a\nb\n', 0), pager.truncate('a\nb\n', 2))
+        self.assertEqual(('a\nb', 0), pager.truncate('a\nb', 2))
+        self.assertEqual(('', 0), pager.truncate('', 2))
+
+    def testTruncated(self):
+        self.assertEqual(('a\nb\n', 2), pager.truncate('a\nb\nc\nd\n', 2))
+        # A final line without a newline is counted.
+        self.assertEqual(('a\n', 2), pager.truncate('a\nb\nc', 1))
+
+
+class SpillTest(unittest.TestCase):
+
+    def testAddAndGet(self):
+        spill = pager.Spill()
+        try:
+            spill.add('b.syd', 'one\n')
+            spill.add('a.syd', 'two\n')
+            spill.add('b.syd', 'three\n')
+            self.assertEqual(['a.syd', 'b.syd'], spill.device_names())
+            self.assertTrue('a.syd' in spill)
+            self.assertFalse('c.syd' in spill)
+            self.assertEqual(['one\n', 'three\n'], list(spill.get('b.syd')))
+            self.assertEqual([], list(spill.get('c.syd')))
+        finally:
+            spill.close()
+
+
+class PagerTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testWritesAll(self):
+        p = pager.Pager('cat > %s' % self.path)
+        text = ''.join('line %d\n' % i for i in xrange(100000))
+        p.write(text)
+        p.write('end\n')
+        p.close()
+        self.assertEqual(text + 'end\n', open(self.path).read())
+
+    def testInterruptibleUntilClosed(self):
+        handler = signal.getsignal(signal.SIGINT)
+        p = pager.Pager('kill -INT $PPID; cat > %s' % self.path)
+        try:
+            self.assertEqual(handler, signal.getsignal(signal.SIGINT))
+            self.assertRaises(KeyboardInterrupt, time.sleep, 5)
+        finally:
+            p.close()
+
+    def testCloseIgnoresInterrupt(self):
+        handler = signal.getsignal(signal.SIGINT)
+        p = pager.Pager('cat > %s; kill -INT $PPID' % self.path)
+        p.write('text\n')
+        p.close()
+        self.assertEqual(handler, signal.getsignal(signal.SIGINT))
+        self.assertEqual('text\n', open(self.path).read())
+
+    def testIgnoreInterrupts(self):
+        handler = signal.getsignal(signal.SIGINT)
+        p = pager.Pager('cat > %s' % self.path)
+        p.ignore_interrupts()
+        self.assertEqual(signal.SIG_IGN, signal.getsignal(signal.SIGINT))
+        p.close()
+        self.assertEqual(handler, signal.getsignal(signal.SIGINT))
+
+    def testReaderQuits(self):
+        handler = signal.getsignal(signal.SIGINT)
+        p = pager.Pager('true')
+        p.ignore_interrupts()
+        p.process.wait()
+        p.write('ignored\n' * 100000)
+        self.assertTrue(p.closed)
+        self.assertEqual(handler, signal.getsignal(signal.SIGINT))
+        p.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
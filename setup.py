@@ -22,11 +22,11 @@ setuptools.setup(
     description='Mister CLI: A multi-router network command-line interface.',
     entry_points = {
         'console_scripts': [
-            'mrcli = mrcli.mrcli:main'
+            'mrcli = mrcli.mrcli:main',
+            'mrcli-bench = mrcli.bench:main',
             ]
         },
-    install_requires=['notch.client',
-                      'pytrie'],
+    install_requires=['notch.client'],
     url='http://code.google.com/p/mr-cli/',
     author='Andrew Fort',
     author_email='notch-dev@googlegroups.com',